@@ -0,0 +1,11 @@
+'''
+__main__.py - 'python -m lockbydir' when lockbydir is used as a package.
+
+See lockbydir_cli.py
+'''
+
+import sys
+
+from lockbydir_cli import main
+
+sys.exit(main())
@@ -22,7 +22,11 @@ underlying DB. See posting: http://stackoverflow.com/q/28030536/3693375
 When no one could really help me to the end, I created this class 'DLock'.
 
 Inner workings:
-A lock is represented by a lockdir, in the current directory (or a RAMDISK).
+A lock is represented by a lockdir, in the lock root directory. By default
+that is a RAM disk (e.g. /dev/shm/lockbydir-<uid>) if there is one, else the 
+current directory. See lockbydir_OS.defaultLockRoot()
+Lock names are relative to the lock root, also "sub/x": missing dirs are
+created there. LOCKROOT = "" locks in the current directory, as before.
 
 While it exists, and its filedate is recent, the lock is 'locked'.
 If the dir does not exist, or is timed out, the lock is 'unlocked'.
@@ -38,6 +42,40 @@ PATIENCE: Seconds after which no more hope to acquire the lock.
 Default TIMEOUT, and PATIENCE can be changed in each DLock instance, 
 or (better) by subclassing DLock. 
 
+Optional priority of a waiter: .LoopWhileLocked_ThenLocking(priority = 10)
+Then lower priority waiters (in all processes) let it go first. The longer
+they wait, the higher their priority grows (PRIORITYAGING), so none starve.
+
+Events (waiting, acquired after how long, gave up, timed out, broke stale lock, released) 
+are logged to the logger named 'lockbydir', at DEBUG resp. INFO and WARNING
+level. Nothing is formatted unless that level is enabled. Nothing is printed
+unless the host app configures logging. Or keep the recent events in memory:
+recordEvents(), see testLogging().
+
+Optional deadlock detection (DETECTDEADLOCKS): Holders and waiters write
+down what they hold, and what they wait for. A waiter follows that chain. 
+If it leads back to itself, that is a deadlock: The youngest waiter in the 
+cycle gets DEADLOCK from .LoopWhileLocked_ThenLocking() - a false value, 
+so 'if not acquired' still works - and should release what it holds.
+
+Locks held by this process are released when it exits (atexit), and - after
+releaseOnSignals() - at SIGTERM and SIGINT. So a restarted worker does not 
+leave its lockdirs behind for TIMEOUT seconds. A child process (fork) does 
+not own the locks of its parent: Its unlocking() does nothing.
+
+Optional admission control (MAXWAITERS, MAXPREDICTEDWAIT): Under overload,
+do not join a long queue, and poll for PATIENCE seconds in vain. Instead get
+REJECTED at once - also false - and degrade gracefully.
+
+Optional watchdog (WATCHDOG): Before a holder exceeds TIMEOUT - at 
+WATCHDOGFRACTION of it - a callback fires: watchdogLog (warning, with the 
+holder's stack), watchdogExtend (touch the lockdir, hold longer), or 
+watchdogRaise (DLockOverrun in the holder's thread). Holders which unlock 
+too late are counted in 'metrics', always.
+
+Reentrant variant RDLock: Nested acquisitions by the holding thread cost 
+nothing. With 'with' blocks, and as decorator. See testRDLock().
+
 Shortest possible usage is in howToUse().
 The inner workings are well explained in testDLocks().
 Parallel processes are shown in 2 examples in 'lockbydir_concurrent.py'. 
@@ -107,13 +145,104 @@ TIMEOUT = 10  # for some of the examples, 10 is optimal.
 # Between first attempt to lock, and finally giving up:
 PATIENCE = 30
 
+# Waiters with a priority are preferred. But the longer a waiter waits, the
+# higher its priority grows, by this much per second. So low priorities are 
+# not starved (if PRIORITYAGING * PATIENCE > biggest priority difference):
+PRIORITYAGING = 1.0
+
+# Record who holds the lock, in a file next to the lockdir: at each locking, 
+# and unlocking. Costs 1 read and 2 small writes. Shows holders, exact 
+# acquisitions/s and hand-off latency in the inspection tool: python -m lockbydir
+RECORDHOLDER = False
+
+# Profiler (see lockbydir_profiler.py), e.g. set by lockbydir_profiler.enable().
+# Records the call sites which hold, and wait for, the lock. None = off.
+PROFILER = None
+
+# Deadlock detection, across processes and threads. Holders record what they
+# hold, waiters what they wait for, in lockbydir.waitfor/ in the lock root. 
+# Costs 1 small write and 1 remove per acquisition, plus a few reads per 
+# poll while waiting. All DLocks of the possible cycles must have it on:
+DETECTDEADLOCKS = False
+
+# Admission control, when the lock is contended. None = off.
+# Reject at once (REJECTED) if that many waiters (in all processes) are
+# already waiting. Waiters are counted in the waiting dir, WAITINGEXTENSION:
+MAXWAITERS = None
+# ... or if the predicted wait is longer than this many seconds. Predicted:
+# (waiters + 1) * average hold time (of this lock, in this process, so far):
+MAXPREDICTEDWAIT = None
+
+# Watchdog of the hold time. None = off. Else a function (L, threadIdent),
+# called at WATCHDOGFRACTION * TIMEOUT after locking, while still held. E.g.
+# watchdogLog, watchdogExtend, watchdogRaise. One thread for all, if needed:
+WATCHDOG = None
+WATCHDOGFRACTION = 0.8
+# how often watchdogExtend may extend one acquisition:
+WATCHDOGMAXEXTENSIONS = 3
+
+# Directory for the lockdirs. Lock names which are absolute paths ignore it.
+# None = automatic choice, preferring a RAM disk. "" = current directory. 
+LOCKROOT = None
+
 # do not change:
 REMOVETIMEDOUT = True  # default: remove old locks when tested by 'isLocked'
 
-import time
+# dir of all looping waiters, next to the lockdir:
+WAITINGEXTENSION = ".waiting"
+
+# priority part of the name of a waiter without priority:
+PLAINWAITER = "plain"
+
+# file with the holder of the lock, see RECORDHOLDER:
+HOLDEREXTENSION = ".holder"
+
+# dir in the lock root, for deadlock detection (DETECTDEADLOCKS):
+WAITFORDIRNAME = "lockbydir.waitfor"
+MAXCYCLE = 100 # longer wait-for chains are not followed
+
+# weight of the newest hold time, in the average hold time (MAXPREDICTEDWAIT):
+HOLDTIMEWEIGHT = 0.2
+
+import time, os, random, sys, platform, threading, functools, logging, collections
+import hashlib, atexit, signal, traceback, heapq, itertools
 
-from lockbydir_OS import LOCKDIREXTENSION, pathExists, pathAgeInSeconds
+from lockbydir_OS import LOCKDIREXTENSION, ERROR, pathExists, pathAgeInSeconds, listdir_OrEmpty
+from lockbydir_OS import defaultLockRoot, checkLockRoot, filesystemType
 from lockbydir_OS import mkdir_ReturnWhetherSuccessful, rmdir_ReturnWhetherSuccessfullyRemoved
+from lockbydir_OS import writeFileAtomically, readFile, remove_ReturnWhetherSuccessfullyRemoved
+from lockbydir_OS import touchPath
+
+# all DLock events go here. Silent, unless the host app configures logging:
+logger = logging.getLogger("lockbydir")
+logger.addHandler(logging.NullHandler())
+DEBUG, INFO, WARNING = logging.DEBUG, logging.INFO, logging.WARNING
+
+# DLocks held by this process: id -> DLock. Released at exit, see releaseAll:
+_held = {}
+_heldLock = threading.RLock() # reentrant: a signal may arrive while it is held
+_processPid = os.getpid() # to notice a fork
+
+# average hold times, in this process: dirname -> seconds. See MAXPREDICTEDWAIT
+_holdTimes = {}
+
+# counters of this process. overruns: unlocking too late (after TIMEOUT)
+metrics = {"overruns": 0, "watchdogFired": 0, "watchdogExtended": 0, 
+           "watchdogRaised": 0}
+overrunsByLock = collections.Counter()
+_metricsLock = threading.Lock()
+
+# WATCHDOG: one thread (started when first needed) sleeps until the earliest
+# deadline in a heap of (deadline, token, key, DLock, lockingTime). Armed 
+# ones: key = (dirname, thread ident) -> token. Disarmed ones stay in the 
+# heap, ignored, until popped or compacted:
+_watchdogs = {}
+_watchdogHeap = []
+_watchdogCondition = threading.Condition(threading.Lock())
+_watchdogTokens = itertools.count()
+_watchdogThread = None
+_watchdogDisarmed = 0 # in the heap
+_watchdogStopping = False
 
 
 class DLock:
@@ -130,7 +259,9 @@ class DLock:
     
     def __init__(self, name):
         self.name = name
-        self.lockingTime = None
+        self.lockingTime = None  # for the TIMEOUT check; the WATCHDOG may extend it
+        self.acquiredTime = None # for the hold time
+        self.lockingPid = None
         self.startedWaitingTime = None
         
         # default values. Overwrite in your instance if other values wanted.
@@ -140,23 +271,79 @@ class DLock:
         self.CHECKEVERYXSECONDS = CHECKEVERYXSECONDS
         self.REMOVETIMEDOUT = REMOVETIMEDOUT
         self.LOCKDIREXTENSION = LOCKDIREXTENSION
-
-    def LoopWhileLocked_ThenLocking(self):
+        self.LOCKROOT = LOCKROOT
+        self.PRIORITYAGING = PRIORITYAGING
+        self.RECORDHOLDER = RECORDHOLDER
+        self.PROFILER = PROFILER
+        self.DETECTDEADLOCKS = DETECTDEADLOCKS
+        self.MAXWAITERS = MAXWAITERS
+        self.MAXPREDICTEDWAIT = MAXPREDICTEDWAIT
+        self.WATCHDOG = WATCHDOG
+        self.WATCHDOGFRACTION = WATCHDOGFRACTION
+        self.WATCHDOGMAXEXTENSIONS = WATCHDOGMAXEXTENSIONS
+        self.extensions = 0
+        self.deadlocked = False
+
+    def LoopWhileLocked_ThenLocking(self, priority = None):
         """THIS is the correct way to acquire a lock.
         
            It waits for lock to open or time out, then tries locking.
            (If many are waiting,) repeat only until PATIENCE is gone. 
            
+           Optional 'priority' (a number, higher is better): Then I do not 
+           try locking while a waiter with higher priority is present 
+           (in any process). See PRIORITYAGING. Without one (None), I count
+           as priority 0: I also give way to higher registered waiters.
+           
            Returns False if locking failed.
            Returns True if locking succeeded.
+           Returns DEADLOCK (which is false, too) if DETECTDEADLOCKS and
+           waiting would never end. Then release the locks you hold!
+           Returns REJECTED (false, too) at once, if MAXWAITERS or 
+           MAXPREDICTEDWAIT would be exceeded.
         """
         self.startedWaitingTime = time.time()
+        self.deadlocked = False
+        prioritized = priority is not None
+        if not prioritized:
+            priority = 0 # gives way to registered waiters with higher priority, too
+        if (not self.higherPriorityWaiting(priority, None) 
+            and self.locking()): # uncontended: 1 stat, 1 mkdir
+            return True
+        admissionControl = (self.MAXWAITERS is not None or 
+                            self.MAXPREDICTEDWAIT is not None)
+        if admissionControl and self.overloaded():
+            if logger.isEnabledFor(INFO):
+                self.logEvent(INFO, "rejected", None)
+            return REJECTED
         acquired = False
+        waiter = self.registerWaiter(priority if prioritized else None) # counted
+        if self.DETECTDEADLOCKS:
+            self.recordWaitsFor()
         
-        while (not acquired and self.stillPatience()):  
-            _ = self.loopWhileLocked() 
-            acquired = self.locking()
+        try:
+            while (not acquired and self.stillPatience()):  
+                _ = self.loopWhileLocked() 
+                if self.deadlocked:
+                    break
+                if self.higherPriorityWaiting(priority, waiter):
+                    time.sleep (self.CHECKEVERYXSECONDS)
+                    continue
+                acquired = self.locking()
+        finally:
+            if waiter:
+                self.unregisterWaiter(waiter)
+            if self.DETECTDEADLOCKS:
+                remove_ReturnWhetherSuccessfullyRemoved(self.waitsForFilename())
             
+        if not acquired and self.PROFILER:
+            self.PROFILER.gaveUp(self, time.time() - self.startedWaitingTime)
+        if not acquired and logger.isEnabledFor(INFO):
+            self.logEvent(INFO, "gave up", time.time() - self.startedWaitingTime)
+        if self.deadlocked:
+            if logger.isEnabledFor(WARNING):
+                self.logEvent(WARNING, "deadlock", time.time() - self.startedWaitingTime)
+            return DEADLOCK
         return acquired 
 
     def unlocking( self ):
@@ -166,27 +353,61 @@ class DLock:
            
            N.B.: Only the rightful lock can use unlocking.
            N.B.: Unlocking is only possible before timeout.
+           N.B.: A forked child process is not the owner. 
            
         """
         
         if self.lockingTime == None: # cannot be the owner
             return False
 
+        elif self.lockingPid != os.getpid(): # forked, the parent owns it
+            return False
+
         # never unlock after timeout, 
         # because it might already be owned by other process!
         elif (time.time() - self.lockingTime) < self.TIMEOUT:
+            if self.WATCHDOG:
+                self.disarmWatchdog()
+            held = time.time() - self.acquiredTime
+            if self.MAXPREDICTEDWAIT is not None:
+                self.recordHoldTime(held)
+            if logger.isEnabledFor(DEBUG):
+                self.logEvent(DEBUG, "released", held)
             self.lockingTime = None
-            return self.breakLock()
+            if self.RECORDHOLDER:
+                self.recordHolder(released = time.time())
+            if self.DETECTDEADLOCKS:
+                remove_ReturnWhetherSuccessfullyRemoved(self.holdsFilename())
+            unregisterHeld(self)
+            released = self.breakLock()
+            if self.PROFILER: # after the release: may write its file
+                self.PROFILER.released(self, held)
+            return released
         else:
+            if self.WATCHDOG:
+                self.disarmWatchdog()
+            if unregisterHeld(self): # count once
+                countMetric("overruns", self.name)
+            if self.PROFILER:
+                self.PROFILER.released(self, time.time() - self.acquiredTime, 
+                                       timedOut = True)
+            if logger.isEnabledFor(WARNING):
+                self.logEvent(WARNING, "timed out", time.time() - self.acquiredTime)
             return False # so it had already timed out
 
     # end PUBLIC functions.
     # begin PRIVATE functions. Usually no need to call them:
 
 
+    def lockRoot (self):
+        "directory in which the lockdir is created"
+        if self.LOCKROOT is None:
+            return defaultLockRoot()
+        return checkLockRoot(self.LOCKROOT)
+
     def dirname (self):
-        "lockname plus extension = lock dir name"
-        return self.name + LOCKDIREXTENSION
+        "lock root plus lockname plus extension = lock dir name"
+        return os.path.join(self.lockRoot(), self.name + self.LOCKDIREXTENSION)
 
     def breakLock(self):
         """Low level routine, do not call directly unless you really know why!
@@ -230,21 +451,75 @@ class DLock:
            ... then return true.
             
            If already existed and not timed out yet, 
-           (or mkdir fails for other reasons), then return false."""
+           (or mkdir fails for other reasons), then return false.
+           
+           mkdir first: Uncontended, that is the only filesystem operation.
+           Only if it fails, look at the existing lockdir: If it is timed 
+           out (then removed, see isLocked), or gone meanwhile, mkdir again."""
            
         self.startWaiting()
            
-        if self.existsAndNotTimedOut():
-            return False
-
         acquired = mkdir_ReturnWhetherSuccessful ( self.dirname() )
+        if not acquired and not self.isLocked():
+            acquired = mkdir_ReturnWhetherSuccessful ( self.dirname() )
         
         if acquired:
-            self.lockingTime = time.time()
+            self.lockingTime = self.acquiredTime = time.time()
+            self.lockingPid = os.getpid()
+            registerHeld(self)
+            if self.PROFILER:
+                self.PROFILER.acquired(self, self.lockingTime - self.startedWaitingTime)
+            if logger.isEnabledFor(DEBUG):
+                self.logEvent(DEBUG, "acquired", self.lockingTime - self.startedWaitingTime)
             self.startedWaitingTime = None
+            if self.RECORDHOLDER:
+                self.recordHolder()
+            if self.DETECTDEADLOCKS:
+                self.recordHolds()
+            if self.WATCHDOG:
+                self.extensions = 0
+                self.armWatchdog(threadIdent())
             
         return acquired
 
+    def logEvent(self, level, event, secs):
+        """Log a lock event, with the lock name, and a duration (if any).
+           Callers check logger.isEnabledFor(level) first, so that nothing
+           is done at all when not enabled. Handlers get the fields as
+           record.lockname, record.event, record.secs"""
+        extra = {"lockname": self.name, "event": event, "secs": secs}
+        if secs is None:
+            logger.log(level, "%s %s", self.name, event, extra = extra)
+        else:
+            logger.log(level, "%s %s %.6f", self.name, event, secs, extra = extra)
+
+    def holderFilename(self):
+        return os.path.join(self.lockRoot(), self.name + HOLDEREXTENSION)
+
+    def recordHolder(self, released = None):
+        """Write who I am into the holder file, for the inspection tool.
+           Also: number of acquisitions, and the hand-off latency (from the 
+           previous holder's release). At unlocking: my 'released' time."""
+        try:
+            if released is None:
+                previous = parseHolder(readFile(self.holderFilename()))
+                handoff = ""
+                if "released" in previous:
+                    handoff = " handoff=%.6f" % (self.lockingTime - 
+                                                 float(previous["released"]))
+                self.holder = ("pid=%d host=%s thread=%s acquired=%.6f "
+                               "timeout=%g seq=%d%s") % (
+                               os.getpid(), platform.node(), 
+                               threading.current_thread().name.replace(" ", "_"),
+                               self.lockingTime, self.TIMEOUT, 
+                               int(previous.get("seq", 0)) + 1, handoff)
+                writeFileAtomically(self.holderFilename(), self.holder)
+            else:
+                writeFileAtomically(self.holderFilename(), 
+                                    self.holder + " released=%.6f" % released)
+        except (IOError, OSError, ValueError):
+            pass # only for information, never let it break the locking
+
 
 
     def stillPatience(self):
@@ -268,17 +543,192 @@ class DLock:
             return False
         
         self.startWaiting()
+        if logger.isEnabledFor(DEBUG):
+            self.logEvent(DEBUG, "waiting", None)
         
         while self.isLocked() and self.stillPatience():
+            if self.DETECTDEADLOCKS and self.deadlockVictim():
+                break
             time.sleep (self.CHECKEVERYXSECONDS)
         return True
 
 
+    def waitingDirname (self):
+        "dir of the waiters with priority, next to the lockdir"
+        return os.path.join(self.lockRoot(), self.name + WAITINGEXTENSION)
+
+    def registerWaiter(self, priority = None):
+        """Make me visible to all waiters: mkdir in the waiting dir. 
+           The name says: priority (or PLAINWAITER), since when, patience, 
+           who. Returns that name."""
+        waiter = "%s_%.6f_%g_%d-%06x" % (PLAINWAITER if priority is None else 
+                 "%g" % priority, self.startedWaitingTime, 
+                 self.PATIENCE, os.getpid(), random.getrandbits(24))
+        waitingDir = self.waitingDirname()
+        mkdir_ReturnWhetherSuccessful ( waitingDir )
+        mkdir_ReturnWhetherSuccessful ( os.path.join(waitingDir, waiter) )
+        return waiter
+
+    def unregisterWaiter(self, waiter):
+        "Remove my mkdir. And the waiting dir, if I was the last one."
+        waitingDir = self.waitingDirname()
+        rmdir_ReturnWhetherSuccessfullyRemoved ( os.path.join(waitingDir, waiter) )
+        rmdir_ReturnWhetherSuccessfullyRemoved ( waitingDir ) # not if others wait
+
+    def waiters(self):
+        """All registered waiters, as list of (priority, since, patience, name).
+           priority is None for those without one. Removes those which have
+           waited longer than their patience."""
+        waitingDir, now, waiters = self.waitingDirname(), time.time(), []
+        for waiter in listdir_OrEmpty( waitingDir ):
+            try:
+                priority, since, patience, _ = waiter.split("_", 3)
+                priority = None if priority == PLAINWAITER else float(priority)
+                since, patience = float(since), float(patience)
+            except ValueError:
+                continue
+            if now - since > patience + 1: # gone, without unregistering
+                rmdir_ReturnWhetherSuccessfullyRemoved ( 
+                                            os.path.join(waitingDir, waiter) )
+                continue
+            waiters.append( (priority, since, patience, waiter) )
+        return waiters
+
+    def higherPriorityWaiting(self, priority, me):
+        """Is there a waiter with higher priority than me? Including aging.
+           Waiters without priority are not: they just race for the lock.
+           Cheap if nobody is registered: then there is no waiting dir."""
+        if not pathExists(self.waitingDirname()):
+            return False
+        now = time.time()
+        mine = priority + self.PRIORITYAGING * (now - self.startedWaitingTime)
+        for priority, since, _, waiter in self.waiters():
+            if priority is None:
+                continue
+            theirs = priority + self.PRIORITYAGING * (now - since)
+            if theirs > mine and waiter != me:
+                return True
+        return False
+
+    def waitforDirname(self):
+        "dir of the wait-for graph, in the lock root. See DETECTDEADLOCKS"
+        return os.path.join(self.lockRoot(), WAITFORDIRNAME)
+
+    def holdsFilename(self, dirname = None):
+        "H_<hash of lockdir name>, contains the holder"
+        key = hashlib.md5(dirname or self.dirname()).hexdigest()[:16]
+        return os.path.join(self.waitforDirname(), "H_" + key)
+
+    def waitsForFilename(self, owner = None):
+        "W_<owner>, contains since when, how patient, and the lockdir name"
+        return os.path.join(self.waitforDirname(), "W_" + (owner or ownerIdent()))
+
+    def writeWaitfor(self, filename, data):
+        try:
+            writeFileAtomically(filename, data)
+        except (IOError, OSError): # no wait-for dir yet
+            mkdir_ReturnWhetherSuccessful ( self.waitforDirname() )
+            writeFileAtomically(filename, data)
+
+    def recordHolds(self):
+        "graph edge: lock -> me, its holder"
+        self.writeWaitfor(self.holdsFilename(), ownerIdent())
+
+    def recordWaitsFor(self):
+        "graph edge: me -> the lock I wait for"
+        self.writeWaitfor(self.waitsForFilename(), "%.6f %g\n%s" % (
+                          self.startedWaitingTime, self.PATIENCE, self.dirname()))
+
+    def holderOf(self, dirname):
+        """Who holds that lockdir, as recorded. None if not recorded, or if
+           recorded for an earlier lockdir (younger than the record)."""
+        filename = self.holdsFilename(dirname)
+        holder = readFile(filename)
+        recordAge, lockAge = pathAgeInSeconds(filename), pathAgeInSeconds(dirname)
+        if (holder is None or recordAge == ERROR or lockAge == ERROR or 
+            recordAge > lockAge or lockAge > self.TIMEOUT):
+            return None
+        return holder
+
+    def waitsFor(self, owner):
+        "(since, lockdir name) which that owner waits for. None if not waiting."
+        data = readFile(self.waitsForFilename(owner))
+        try:
+            times, dirname = data.split("\n", 1)
+            since, patience = [float(x) for x in times.split()]
+        except (AttributeError, ValueError):
+            return None
+        if time.time() - since > patience + 1: # gone, without cleaning up
+            return None
+        return since, dirname
+
+    def deadlockCycle(self):
+        """Follow the wait-for chain from me: the lock I wait for, its 
+           holder, the lock that one waits for, ... If it leads back to me,
+           return the cycle as list of (since, owner). Else None."""
+        me = ownerIdent()
+        since = float("%.6f" % self.startedWaitingTime) # as others read it
+        cycle, dirname = [(since, me)], self.dirname()
+        for _ in range(MAXCYCLE):
+            holder = self.holderOf(dirname)
+            if holder == me:
+                return cycle
+            if holder is None or holder in [owner for _, owner in cycle]:
+                return None # no cycle, or one which I am not part of
+            waiting = self.waitsFor(holder)
+            if waiting is None:
+                return None
+            since, dirname = waiting
+            cycle.append( (since, holder) )
+        return None
+
+    def deadlockVictim(self):
+        """Am I in a deadlock cycle, and the one who has to give up?
+           The youngest waiter gives up. (Sets self.deadlocked)"""
+        cycle = self.deadlockCycle()
+        if cycle is not None and max(cycle)[1] == ownerIdent():
+            self.deadlocked = True
+        return self.deadlocked
+
+    def armWatchdog(self, ident):
+        "WATCHDOG fires at WATCHDOGFRACTION of TIMEOUT from lockingTime"
+        watchdogArm(self, ident)
+
+    def disarmWatchdog(self):
+        watchdogDisarm((self.dirname(), threadIdent()))
+
+    def watchdogFired(self, lockingTime, ident):
+        "In the watchdog thread. If still held: call WATCHDOG, re-arm if extended."
+        if self.lockingTime != lockingTime: # released (or extended) meanwhile
+            return
+        countMetric("watchdogFired")
+        if self.WATCHDOG(self, ident):
+            self.armWatchdog(ident)
+
+    def overloaded(self):
+        """Too many waiters (MAXWAITERS), or predicted wait too long 
+           (MAXPREDICTEDWAIT)? Waiters: all processes, counted in the 
+           waiting dir. Hold time: average in this process."""
+        waiters = len(self.waiters())
+        if self.MAXWAITERS is not None and waiters >= self.MAXWAITERS:
+            return True
+        holdTime = _holdTimes.get(self.dirname())
+        return (self.MAXPREDICTEDWAIT is not None and holdTime is not None and
+                (waiters + 1) * holdTime > self.MAXPREDICTEDWAIT)
+
+    def recordHoldTime(self, secs):
+        "moving average of the hold times of this lock, in this process"
+        key = self.dirname()
+        average = _holdTimes.get(key)
+        _holdTimes[key] = secs if average is None else (
+                          average + HOLDTIMEWEIGHT * (secs - average))
+
     def removeIfTimedOut (self):
         "delete the lockfile after timeout"
         # TODO: how to make this atomic ??????????????
         if self.timedOut():
-            self.breakLock()    
+            if self.breakLock() and logger.isEnabledFor(INFO):
+                self.logEvent(INFO, "broke stale lock", None)
 
     def isLocked( self ): 
         """If locked, return True.
@@ -296,19 +746,414 @@ class DLock:
         return True # in all other cases it is locked
 
 
+class NotAcquired(object):
+    """False result of .LoopWhileLocked_ThenLocking(), with the reason.
+       'if not acquired:' works as with False."""
 
-def getInfoLogger(ID = ""):
-    "nice printing with timestamp and choosable IDs"
-    
-    # reload to redefine basicConfig:
-    import sys, logging; reload(sys.modules['logging']); import logging
-    FORMAT = '[%(asctime)s.%(msecs).03d] ' + ID + ' %(message)s'
-    logging.basicConfig(format=FORMAT,  datefmt='%I:%M:%S', level=logging.DEBUG)
-    logger = logging.getLogger(__name__)
-    return logger.info 
+    def __init__(self, reason):
+        self.reason = reason
+
+    def __nonzero__(self):
+        return False
+
+    def __repr__(self):
+        return "NotAcquired(%r)" % self.reason
+
+# waiting would never end. See DETECTDEADLOCKS:
+DEADLOCK = NotAcquired("deadlock")
+
+# too many waiters, or too long predicted wait. See MAXWAITERS, MAXPREDICTEDWAIT:
+REJECTED = NotAcquired("rejected")
 
-#    logger = getLogger('[%(asctime)s.%(msecs).03d] ' + ID + ' %(message)s')
+
+class DLockNotAcquired(Exception):
+    "Raised by 'with RDLock(...)', if PATIENCE was gone before locking, or DEADLOCK, REJECTED."
+
+
+# owners of RDLocks in this process: 
+# dirname -> [thread ident, count, lockingTime, pid, id of the acquiring instance,
+#             acquiredTime]
+_reentrantOwners = {}
+_reentrantOwnersLock = threading.RLock() # reentrant, see _heldLock
+
+class RDLock (DLock):
+    """Reentrant DLock: The thread which holds it can acquire it again, 
+       and again - without waiting, and without touching the filesystem. 
+       Only the outermost acquire and release create and remove the lockdir. 
+       Also across instances: what counts is the 'name', as always.
     
+       Usable as context manager, and as decorator:
+       
+           with RDLock("orders"):        # raises DLockNotAcquired
+               ...                       # if PATIENCE was gone
+           
+           @RDLock("orders")
+           def f(): ...
+    """
+
+    def LoopWhileLocked_ThenLocking(self, priority = None):
+        "If my thread holds it already: True at once. Else like DLock."
+        if self.enterNested():
+            return True
+        return DLock.LoopWhileLocked_ThenLocking(self, priority)
+
+    def unlocking(self):
+        """Release one level. Only the outermost really unlocks.
+           Returns True if released, like DLock. False if this instance
+           does not hold a level (never acquired, or released already)."""
+        if self.lockingTime == None: # cannot be the owner
+            return False
+        key, me = self.dirname(), threadIdent()
+        checkForked()
+        with _reentrantOwnersLock:
+            owner = _reentrantOwners.get(key)
+            if owner is None or owner[0] != me:
+                return DLock.unlocking(self) # not mine, or not reentrant
+            if owner[5] != self.acquiredTime: # my hold timed out, taken over since
+                self.lockingTime = None
+                if unregisterHeld(self):
+                    countMetric("overruns", self.name)
+                return False
+            owner[1] -= 1
+            if owner[1] > 0:
+                self.lockingTime = None
+                return True
+            del _reentrantOwners[key]
+        self.lockingTime, self.lockingPid, self.acquiredTime = owner[2], owner[3], owner[5]
+        if owner[4] != id(self): # acquired by another instance: release it as mine
+            with _heldLock:
+                if _held.pop(owner[4], None) is not None:
+                    _held[id(self)] = self
+        return DLock.unlocking(self)
+
+    def __enter__(self):
+        acquired = self.LoopWhileLocked_ThenLocking()
+        if isinstance(acquired, NotAcquired):
+            raise DLockNotAcquired("'%s' not acquired: %s" % (self.name, acquired.reason))
+        if not acquired:
+            raise DLockNotAcquired("'%s' not acquired within PATIENCE = %s seconds" 
+                                   % (self.name, self.PATIENCE))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.unlocking()
+        return False
+
+    def __call__(self, fn):
+        "decorator: run fn while holding the lock, in its own instance"
+        @functools.wraps(fn)
+        def locked(*args, **kwargs):
+            with self.copy():
+                return fn(*args, **kwargs)
+        return locked
+
+    # end PUBLIC functions.
+    # begin PRIVATE functions. Usually no need to call them:
+
+    def copy(self):
+        "new instance with the same name and parameters, but own state"
+        L = self.__class__(self.name)
+        for attr, value in self.__dict__.items():
+            if attr.isupper():
+                setattr(L, attr, value)
+        return L
+
+    def enterNested(self):
+        """If my thread holds the lock: count one level more, return True.
+           If its hold is timed out, the lockdir may belong to someone else
+           now: forget that hold, return False (so acquire it like DLock)."""
+        key, me = self.dirname(), threadIdent()
+        checkForked()
+        with _reentrantOwnersLock:
+            owner = _reentrantOwners.get(key)
+            if owner is None or owner[0] != me:
+                return False
+            if time.time() - owner[2] >= self.TIMEOUT:
+                del _reentrantOwners[key]
+                return False
+            owner[1] += 1
+        self.lockingTime, self.lockingPid, self.acquiredTime = owner[2], owner[3], owner[5]
+        self.startedWaitingTime = None
+        return True
+
+    def locking(self):
+        "Like DLock, but if my thread holds it already: True at once."
+        if self.enterNested():
+            return True
+        acquired = DLock.locking(self)
+        if acquired:
+            with _reentrantOwnersLock:
+                _reentrantOwners[self.dirname()] = [threadIdent(), 1, self.lockingTime,
+                                                    self.lockingPid, id(self),
+                                                    self.acquiredTime]
+        return acquired
+
+def threadIdent():
+    return threading.current_thread().ident
+
+def ownerIdent():
+    "who holds, and waits: this thread of this process"
+    return "%d-%d" % (os.getpid(), threadIdent())
+
+
+def countMetric(key, lockname = None):
+    with _metricsLock:
+        metrics[key] += 1
+        if lockname is not None:
+            overrunsByLock[lockname] += 1
+
+
+class DLockOverrun(Exception):
+    "Raised by watchdogRaise in the holder's thread, before TIMEOUT is over."
+
+def holderStack(ident):
+    "stack of the thread 'ident', as text"
+    frame = sys._current_frames().get(ident)
+    if frame is None:
+        return "(thread gone)\n"
+    return "".join(traceback.format_stack(frame))
+
+def watchdogLog(L, ident):
+    "WATCHDOG: a warning, with the stack of the holding thread."
+    logger.warning("%s held for %.3f seconds, TIMEOUT is %g. Holder:\n%s", 
+                   L.name, time.time() - L.acquiredTime, L.TIMEOUT, holderStack(ident))
+    return False
+
+def watchdogExtend(L, ident):
+    """WATCHDOG: Touch the lockdir, so that it times out TIMEOUT seconds from
+       now. At most WATCHDOGMAXEXTENSIONS times, then like watchdogLog. 
+       Returns whether extended."""
+    now = time.time()
+    if (L.extensions >= L.WATCHDOGMAXEXTENSIONS or now - L.lockingTime >= L.TIMEOUT
+        or not touchPath(L.dirname())):
+        return watchdogLog(L, ident)
+    L.lockingTime, L.extensions = now, L.extensions + 1
+    with _reentrantOwnersLock:
+        owner = _reentrantOwners.get(L.dirname())
+        if owner is not None and owner[0] == ident:
+            owner[2] = now # RDLock: the instance which unlocks, takes it from here
+    countMetric("watchdogExtended")
+    if logger.isEnabledFor(INFO):
+        L.logEvent(INFO, "extended", None)
+    return True
+
+def watchdogRaise(L, ident):
+    """WATCHDOG: Raise DLockOverrun in the holding thread. It arrives when
+       that thread next runs Python code (not during a long C call); in 
+       Python 2 only every sys.getcheckinterval() bytecodes."""
+    import ctypes
+    watchdogLog(L, ident)
+    ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_long(ident), 
+                                               ctypes.py_object(DLockOverrun))
+    countMetric("watchdogRaised")
+    return False
+
+
+def watchdogArm(L, ident):
+    "Put L into the heap of the watchdog thread. Start that, if not yet."
+    global _watchdogThread
+    key = (L.dirname(), ident)
+    token = next(_watchdogTokens)
+    entry = (L.lockingTime + L.TIMEOUT * L.WATCHDOGFRACTION, token, key, 
+             L, L.lockingTime)
+    with _watchdogCondition:
+        if _watchdogs.get(key) is not None:
+            watchdogDisarmed(1) # replaced
+        _watchdogs[key] = token
+        heapq.heappush(_watchdogHeap, entry)
+        if _watchdogThread is None:
+            _watchdogThread = threading.Thread(target = watchdogLoop, 
+                                               name = "lockbydir-watchdog")
+            _watchdogThread.daemon = True
+            _watchdogThread.start()
+        elif _watchdogHeap[0][1] == token: # earlier than the thread sleeps for
+            _watchdogCondition.notify()
+
+def watchdogDisarm(key):
+    "Cancel the armed watchdog of key = (dirname, thread ident), if any."
+    with _watchdogCondition:
+        if _watchdogs.pop(key, None) is not None:
+            watchdogDisarmed(1)
+
+def watchdogDisarmed(n):
+    """Count disarmed entries in the heap. Remove them all, when they are 
+       the majority. Only with _watchdogCondition."""
+    global _watchdogDisarmed
+    _watchdogDisarmed += n
+    if _watchdogDisarmed > 100 and 2 * _watchdogDisarmed > len(_watchdogHeap):
+        _watchdogHeap[:] = [entry for entry in _watchdogHeap 
+                            if _watchdogs.get(entry[2]) == entry[1]]
+        heapq.heapify(_watchdogHeap)
+        _watchdogDisarmed = 0
+
+def watchdogLoop():
+    "The watchdog thread: calls watchdogFired of each armed DLock at its deadline."
+    heap, cond = _watchdogHeap, _watchdogCondition
+    with cond:
+        while not _watchdogStopping:
+            if heap and _watchdogs.get(heap[0][2]) != heap[0][1]:
+                heapq.heappop(heap) # disarmed
+                watchdogDisarmed(-1)
+                continue
+            if not heap:
+                cond.wait()
+                continue
+            deadline, token, key, L, lockingTime = heap[0]
+            if deadline > time.time():
+                cond.wait(deadline - time.time())
+                continue
+            heapq.heappop(heap)
+            del _watchdogs[key]
+            cond.release()
+            try:
+                L.watchdogFired(lockingTime, key[1])
+            except Exception:
+                logger.exception("%s watchdog failed", L.name)
+            finally:
+                cond.acquire()
+
+def watchdogStop():
+    "At exit: end the watchdog thread, before the interpreter is torn down."
+    global _watchdogStopping
+    with _watchdogCondition:
+        _watchdogStopping = True
+        _watchdogCondition.notify()
+    if _watchdogThread is not None and _watchdogThread.is_alive():
+        _watchdogThread.join(1)
+
+atexit.register(watchdogStop)
+
+
+def checkForked():
+    """In a forked child: forget the parent's held locks, reentrant owners,
+       and armed watchdogs. (The parent still holds them, not the child.)
+       The watchdog thread is gone in the child: start a new one if needed."""
+    global _processPid, _watchdogCondition, _watchdogThread, _watchdogDisarmed
+    if os.getpid() != _processPid:
+        _processPid = os.getpid()
+        _held.clear()
+        _reentrantOwners.clear()
+        _watchdogCondition = threading.Condition(threading.Lock())
+        _watchdogHeap[:] = []
+        _watchdogs.clear()
+        _watchdogThread, _watchdogDisarmed = None, 0
+
+def registerHeld(L):
+    "L was acquired by this process: release it at exit. See releaseAll"
+    with _heldLock:
+        checkForked()
+        _held[id(L)] = L
+
+def unregisterHeld(L):
+    "L is not held anymore. Returns whether it was registered."
+    with _heldLock:
+        return _held.pop(id(L), None) is not None
+
+def releaseAll():
+    """Unlock all DLocks held by this process. Called at exit, and by the
+       handlers of releaseOnSignals(). Returns how many were released."""
+    with _heldLock:
+        checkForked()
+        held = _held.values()
+    with _reentrantOwnersLock:
+        owners = dict(_reentrantOwners)
+        _reentrantOwners.clear() # outermost level at once
+    released = 0
+    for L in held:
+        owner = owners.get(L.dirname())
+        if owner is not None: # an RDLock, maybe inside a level of another instance
+            L.lockingTime, L.lockingPid, L.acquiredTime = owner[2], owner[3], owner[5]
+        if L.unlocking():
+            released += 1
+            if logger.isEnabledFor(INFO):
+                L.logEvent(INFO, "released at exit", None)
+    return released
+
+atexit.register(releaseAll)
+
+def releaseOnSignals(signums = (signal.SIGTERM, signal.SIGINT)):
+    """Release all held DLocks when one of these signals arrives. Then the
+       previous handler runs as before (e.g. KeyboardInterrupt), or for the 
+       default handler, the process ends as it would have. An ignored
+       signal stays ignored, and releases nothing. A handler installed from
+       C (e.g. by uwsgi) cannot be chained, so it is left alone, too; the 
+       locks are then released at exit, if the process exits normally.
+       Call from the main thread, after the app installed its own handlers."""
+    for signum in signums:
+        previous = signal.getsignal(signum)
+        if previous == signal.SIG_IGN or previous is None: # None: not from Python
+            continue
+        def handler(signum, frame, previous = previous):
+            releaseAll()
+            if callable(previous):
+                previous(signum, frame)
+            elif previous == signal.SIG_DFL:
+                signal.signal(signum, signal.SIG_DFL)
+                os.kill(os.getpid(), signum)
+        signal.signal(signum, handler)
+
+
+def parseHolder(data):
+    "holder file content 'key=value key=value ...' as dict"
+    holder = {}
+    for field in (data or "").split():
+        key, _, value = field.partition("=")
+        holder[key] = value
+    return holder
+
+
+class RingBufferHandler(logging.Handler):
+    """Keeps the last 'capacity' log records in memory. Formatted only when
+       dumped. For looking at the recent lock events, e.g. after a problem."""
+
+    def __init__(self, capacity = 1000):
+        logging.Handler.__init__(self)
+        self.buffer = collections.deque(maxlen = capacity)
+        self.setFormatter(logging.Formatter(
+                '[%(asctime)s.%(msecs).03d] %(process)d %(threadName)s %(levelname)s %(message)s',
+                datefmt = '%H:%M:%S'))
+
+    def emit(self, record):
+        self.buffer.append(record)
+
+    def records(self):
+        return list(self.buffer)
+
+    def dump(self, stream = None):
+        "Return the buffered records as formatted lines. Also write to 'stream'."
+        lines = [self.format(record) for record in list(self.buffer)]
+        if stream is not None:
+            for line in lines:
+                stream.write(line + "\n")
+        return lines
+
+def recordEvents(capacity = 1000, level = DEBUG):
+    """Keep the last 'capacity' lock events (of 'level' and above) in memory.
+       Returns the RingBufferHandler, see its .dump()"""
+    handler = RingBufferHandler(capacity)
+    logger.addHandler(handler)
+    if logger.level == logging.NOTSET or logger.level > level:
+        logger.setLevel(level)
+    return handler
+
+
+# loggers of getInfoLogger, by ID:
+_infoLoggers = {}
+
+def getInfoLogger(ID = ""):
+    """nice printing with timestamp and choosable IDs. For the examples.
+       Own logger per ID; does not touch the logging setup of the host app."""
+    if ID not in _infoLoggers:
+        exampleLogger = logging.getLogger("lockbydir.examples.%d" % len(_infoLoggers))
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter(
+                '[%(asctime)s.%(msecs).03d] ' + ID + ' %(message)s', datefmt='%I:%M:%S'))
+        exampleLogger.addHandler(handler)
+        exampleLogger.setLevel(logging.INFO)
+        exampleLogger.propagate = False
+        _infoLoggers[ID] = exampleLogger
+    return _infoLoggers[ID].info
+
 
 
 def testDLock():
@@ -398,6 +1243,242 @@ def testDLock():
     Log("L.isLocked = %s" % L.isLocked())
     Log("End. More examples in the other files.")
 
+def testPriorities(n = 5):
+    "Low priority waiters came first, but the high priority one is next."
+    
+    import threading
+    name, order = "priorityExample", []
+    L = DLock(name)
+    L.breakLock()
+    L.locking()
+    
+    def waiter(i, priority):
+        W = DLock(name)
+        if W.LoopWhileLocked_ThenLocking(priority):
+            order.append( (i, priority) )
+            time.sleep(0.05)
+            W.unlocking()
+    
+    t = [threading.Thread(target = waiter, args = (i, 0)) for i in range(n)]
+    t.append(threading.Thread(target = waiter, args = (n, 10)))
+    for thr in t: 
+        thr.start()
+        time.sleep(0.05)
+    L.unlocking()
+    for thr in t: thr.join()
+    print "Order of acquisition (waiter, priority):", order
+
+
+def testRDLock():
+    "Nested acquisitions of the same lock, in one thread. No self-deadlock."
+    
+    @RDLock("reentrantExample")
+    def helper():
+        with RDLock("reentrantExample") as L:
+            return "helper got it, nesting level %d" % (
+                    _reentrantOwners[L.dirname()][1])
+    
+    L = RDLock("reentrantExample")
+    L.PATIENCE = 1
+    start = time.time()
+    print "outer:", L.LoopWhileLocked_ThenLocking(), 
+    print "|", helper(), "| in %.4f seconds" % (time.time() - start)
+    print "outer unlocking:", L.unlocking(), "| lockdir exists:", L.exists()
+    
+    with L:
+        other = DLock("reentrantExample")
+        other.PATIENCE = 0.5
+        print "other thread (not reentrant) gets it:", 
+        t = threading.Thread(target = lambda: 
+                             sys.stdout.write(" %s\n" % other.LoopWhileLocked_ThenLocking()))
+        t.start()
+        t.join()
+
+
+def testDeadlock():
+    """Two threads, each holds one lock, and waits for the other's. 
+    Without detection both would wait PATIENCE long. With it, one gives up 
+    at once, and releases its lock. Then the other one can go on."""
+    
+    results = {}
+    bothHolding = threading.Event()
+    holding = []
+    
+    def worker(first, second):
+        A, B = DLock(first), DLock(second)
+        for L in (A, B):
+            L.DETECTDEADLOCKS, L.PATIENCE = True, 5
+        A.LoopWhileLocked_ThenLocking()
+        holding.append(first)
+        if len(holding) == 2: bothHolding.set()
+        bothHolding.wait()
+        start = time.time()
+        acquired = B.LoopWhileLocked_ThenLocking()
+        results[first] = (acquired, time.time() - start)
+        if acquired:
+            B.unlocking()
+        A.unlocking()
+    
+    for name in ("deadlockExampleA", "deadlockExampleB"):
+        DLock(name).breakLock()
+    t = [threading.Thread(target = worker, args = ("deadlockExampleA", "deadlockExampleB")),
+         threading.Thread(target = worker, args = ("deadlockExampleB", "deadlockExampleA"))]
+    for thr in t: thr.start()
+    for thr in t: thr.join()
+    for first in sorted(results):
+        print "holding %s, waiting for the other: %r after %.3f seconds" % (
+               first, results[first][0], results[first][1])
+
+
+def testReleaseAtExit():
+    """A process holds a lock, and gets SIGTERM: the next one need not wait
+    for TIMEOUT. A forked child does not own the parent's lock."""
+    
+    import subprocess
+    code = ("import lockbydir, sys, time; lockbydir.releaseOnSignals(); "
+            "L = lockbydir.DLock('exitExample'); L.locking(); "
+            "print 'holding'; sys.stdout.flush(); time.sleep(60)")
+    p = subprocess.Popen([sys.executable, "-c", code], stdout = subprocess.PIPE,
+                         cwd = os.path.dirname(os.path.abspath(__file__)))
+    p.stdout.readline()
+    p.terminate()
+    p.wait()
+    L = DLock("exitExample")
+    start = time.time()
+    print "after SIGTERM of the holder: acquired = %s after %.3f seconds (TIMEOUT = %s)" % (
+           L.LoopWhileLocked_ThenLocking(), time.time() - start, L.TIMEOUT)
+    
+    if hasattr(os, "fork"):
+        pid = os.fork()
+        if pid == 0: # child: its unlocking, and its exit, leave it locked
+            unlocked = L.unlocking() or releaseAll()
+            os._exit(0 if not unlocked and L.exists() else 1)
+        _, status = os.waitpid(pid, 0)
+        print "forked child did not unlock the parent's lock: %s" % (status == 0)
+    print "parent unlocking: %s" % L.unlocking()
+
+
+def testAdmission(clients = 30, maxWaiters = 3):
+    """A hot lock: many clients arrive, each holds 50 ms. Without admission
+    control, most of them wait their whole PATIENCE, in vain. With it, they 
+    are rejected at once, and can do something else."""
+    
+    def run(maxWaiters):
+        results = []
+        def client():
+            L = DLock("admissionExample")
+            L.PATIENCE, L.CHECKEVERYXSECONDS, L.MAXWAITERS = 1, 0.005, maxWaiters
+            start = time.time()
+            acquired = L.LoopWhileLocked_ThenLocking()
+            waited = time.time() - start
+            if acquired:
+                time.sleep(0.05)
+                L.unlocking()
+            results.append( (acquired, waited) )
+        t = [threading.Thread(target = client) for _ in range(clients)]
+        for thr in t: 
+            thr.start()
+            time.sleep(0.005)
+        for thr in t: thr.join()
+        
+        outcome = lambda r: "acquired" if r is True else getattr(r, "reason", "gave up")
+        for kind in ("acquired", "rejected", "gave up"):
+            these = [waited for r, waited in results if outcome(r) == kind]
+            print "   %2d %-8s waited %6.3f seconds in total" % (len(these), kind, sum(these))
+    
+    DLock("admissionExample").breakLock()
+    print "without admission control:"
+    run(None)
+    print "MAXWAITERS = %d:" % maxWaiters
+    run(maxWaiters)
+
+
+def testWatchdog():
+    """Holders which need longer than TIMEOUT: warned, extended, interrupted.
+    And one without watchdog: its overrun is counted."""
+    
+    events = recordEvents(capacity = 100, level = INFO)
+    
+    def holder(watchdog, secs):
+        L = DLock("watchdogExample")
+        L.TIMEOUT, L.WATCHDOG = 0.5, watchdog
+        L.LoopWhileLocked_ThenLocking()
+        try:
+            for _ in range(int(secs / 0.001)): # working
+                time.sleep(0.001)
+            result = "worked %.1f seconds" % secs
+        except DLockOverrun:
+            result = "interrupted (DLockOverrun)"
+        return "%s, unlocking = %s" % (result, L.unlocking())
+    
+    DLock("watchdogExample").breakLock()
+    print "TIMEOUT = 0.5, watchdog at %g of it:" % WATCHDOGFRACTION
+    print "watchdogLog:    ", holder(watchdogLog, 0.6)
+    DLock("watchdogExample").breakLock()
+    print "watchdogExtend: ", holder(watchdogExtend, 1.0)
+    print "watchdogRaise:  ", holder(watchdogRaise, 1.0)
+    print "no watchdog:    ", holder(None, 0.6)
+    DLock("watchdogExample").breakLock()
+    logger.removeHandler(events)
+    
+    print "metrics:", metrics, dict(overrunsByLock)
+    warning = [line for line in events.dump() if "WARNING" in line][0].splitlines()
+    print "first warning: %s ... %s" % (warning[0], warning[-2].strip())
+
+
+def testLogging(n = 100000):
+    """Lock events kept in memory, and dumped. 
+       And what logging costs, when not enabled."""
+    
+    L = DLock("loggingExample")
+    L.breakLock()
+    
+    start = time.time()
+    for _ in range(n):
+        if logger.isEnabledFor(DEBUG):
+            L.logEvent(DEBUG, "acquired", 0)
+    print "disabled: %.3f microseconds per event" % ((time.time() - start) / n * 1e6)
+    
+    events = recordEvents(capacity = 10)
+    L.TIMEOUT, L.PATIENCE = 0.2, 0.1
+    L.locking()
+    L2 = DLock("loggingExample")
+    L2.TIMEOUT, L2.PATIENCE = 0.2, 0.1
+    L2.LoopWhileLocked_ThenLocking()   # gives up
+    time.sleep(0.2)
+    L.unlocking()                      # too late: timed out
+    L2.LoopWhileLocked_ThenLocking()   # breaks the stale lock
+    L2.unlocking()
+    logger.removeHandler(events)
+    
+    print "the last %d lock events:" % len(events.records())
+    events.dump(sys.stdout)
+
+
+def benchmarkUncontended(n = 20000, repeat = 5):
+    """Latency of an uncontended acquire plus release, in microseconds 
+    (best of 'repeat' runs). And how many filesystem operations it costs 
+    (counted in the harness)."""
+    
+    L = DLock("benchmarkExample")
+    L.breakLock()
+    for acquire in ("locking", "LoopWhileLocked_ThenLocking"):
+        best = None
+        for _ in range(repeat):
+            start = time.time()
+            for _ in range(n):
+                getattr(L, acquire)()
+                L.unlocking()
+            best = min(best or 1e9, time.time() - start)
+        print "%-28s + unlocking: %6.2f microseconds" % (acquire, best / n * 1e6),
+        print "in lock root '%s'" % L.lockRoot()
+    
+    import lockbydir_harness
+    report = lockbydir_harness.Harness(processes = 1, rounds = 100, hold = 0).run()
+    print "filesystem operations per acquisition plus release: %.1f" % (
+           float(report["fsops"]) / report["acquisitions"])
+
+
 def print_Ramdisk_Manual():
     """Measured:
     500 threads waiting for 1 DLock - overhead by threading, print, and locking:
@@ -412,16 +1493,25 @@ def print_Ramdisk_Manual():
         with RAMDISK: min=0.0003 max=0.0018 median=0.0007 mean=0.0008 stdv=0.0003
         
     So: When time critical, put DLock in RAM! And lower the 'CHECKEVERYXSECONDS'.
+    DLock now does the first part automatically, see lockbydir_OS.defaultLockRoot
     """
 
+    root = defaultLockRoot()
     print "\nN.B.:"
-    print"""A (tiny!) ramdisk reduces the overhead of frequent read/writes. On Linux:
+    print "DLocks are created in lock root = '%s'" % (root or os.getcwd()),
+    print "(filesystem type: %s)" % filesystemType(root)
+    
+    if root: 
+        print "That is a RAM disk, so the overhead of frequent read/writes is low."
+    else:
+        print"""No RAM disk found (like /dev/shm). A (tiny!) ramdisk reduces the 
+overhead of frequent read/writes. On Linux:
     modprobe rd
     mkfs -q /dev/ram1 100
     mkdir -p /ramcache
     mount /dev/ram1 /ramcache
     df -H | grep ramcache"""
-    print "Then you simple use lockname = '/ramcache/lockname'"
+        print "Then you simply set lockbydir.LOCKROOT = '/ramcache'"
     print
 
 
@@ -436,7 +1526,19 @@ def howToUse(secs = 9):
     return acquired         # Optional: Tell the caller.
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1: # python -m lockbydir list | watch
+        import lockbydir_cli
+        sys.exit(lockbydir_cli.main(sys.argv[1:]))
+
     # print_Ramdisk_Manual()
+    # testPriorities()
+    # testRDLock()
+    # testLogging()
+    # testDeadlock()
+    # testReleaseAtExit()
+    # testAdmission()
+    # testWatchdog()
+    # benchmarkUncontended()
     
     testDLock()
     howToUse(1)
@@ -11,7 +11,7 @@ lockbydir_OS.py - OS Level routines, for DLock = Locking across processes.
 @requires: lockbydir_concurrent.py         # for multiprocess example   
 
 @call:     run
-@return:   stdout (2 tests)
+@return:   stdout (3 tests)
 
 @summary 
 
@@ -24,6 +24,9 @@ This file contains all routines for the OS level:
 * filepath existence, modification date, age
 * mkdir
 * rmdir
+* lock root: where the lockdirs live (preferably on a RAM disk)
+* small files next to the lockdirs: atomic write, read, remove
+* doorbells: wake up waiting processes, instead of letting them poll
 
 
 See my github For feature requests, ideas, suggestions, appraisal, criticism:
@@ -34,10 +37,27 @@ See my github For feature requests, ideas, suggestions, appraisal, criticism:
 # dir extension:
 LOCKDIREXTENSION = ".lockdir"
 
+# where to put the lockdirs, if DLock is not told otherwise.
+# Tried in this order, but only used if on a RAM filesystem (tmpfs):
+# One per user (%(uid)s = the user id), because the first process creates
+# it, with its own owner. Locks shared between users: set LOCKROOT to a dir
+# which all of them can write to.
+LOCKROOTCANDIDATES = ["/dev/shm/lockbydir-%(uid)s", "$XDG_RUNTIME_DIR/lockbydir"]
+
+# filesystem types (as in /proc/mounts):
+RAMFILESYSTEMS = ("tmpfs", "ramfs")
+SLOWFILESYSTEMS = ("nfs", "nfs4", "cifs", "smbfs", "smb3", "9p", "vboxsf", 
+                   "fuse.sshfs", "afs", "ceph", "glusterfs", "fuse.glusterfs",
+                   "lustre", "gpfs", "davfs", "fuse.davfs2")
+
+# without named pipes (Windows), doorbell waiters check this often (seconds):
+DOORBELLPOLL = 0.05
+
 # do not change:
 ERROR = -1             # when filedate not accessible = other process writes.
+DOORBELLEXTENSION = ".fifo"
 
-import os, datetime, math
+import os, datetime, math, warnings, random, time, select, errno
 
 
 def pathExists (pathname):
@@ -103,6 +123,15 @@ def millisecondsPrecisionOnly (DT):
     return DT.replace (microsecond = microseconds)
 
 
+def touchPath(pathname):
+    """Set modification date of path to now, e.g. to renew a lock.
+       Returns False if the path does not exist (anymore)."""
+    try:
+        os.utime(pathname, None)
+        return True
+    except OSError:
+        return False
+
 def pathAgeInSeconds(pathname):
     "Last modification of path was how many seconds ago?"
     try:
@@ -118,6 +147,94 @@ def pathAgeInSeconds(pathname):
     return age
 
 
+## lock root: the directory in which all lockdirs are created.
+## A RAM disk is several times faster, see lockbydir.print_Ramdisk_Manual
+
+def mountTable():
+    """list of (mountpoint, filesystemtype), from /proc/mounts.
+       Empty list if not available (e.g. on Windows)."""
+    try:
+        with open("/proc/mounts") as f:
+            lines = f.readlines()
+    except (IOError, OSError):
+        return []
+    table = []
+    for line in lines:
+        fields = line.split()
+        if len(fields) >= 3:
+            mountpoint = fields[1].replace("\\040", " ") # escaped blanks
+            table.append( (mountpoint, fields[2]) )
+    return table
+
+def filesystemType(pathname):
+    """Type of the filesystem on which 'pathname' is, e.g. 'tmpfs', 'ext4', 'nfs'. 
+       Returns None if unknown."""
+    path = os.path.realpath(os.path.abspath(pathname or os.curdir))
+    longest, fstype = "", None
+    for mountpoint, mounttype in mountTable():
+        inside = (path == mountpoint or 
+                  path.startswith(mountpoint.rstrip("/") + "/"))
+        if inside and len(mountpoint) >= len(longest): # last mount wins
+            longest, fstype = mountpoint, mounttype
+    return fstype
+
+def isSlowFilesystem(fstype):
+    "network or otherwise slow storage?"
+    return fstype in SLOWFILESYSTEMS
+
+def usableRamLockRoot(pathname):
+    """Creates 'pathname' if necessary. No root privileges needed.
+       Returns True if it is a writable dir on a RAM filesystem."""
+    parent = os.path.dirname(pathname)
+    if not os.path.isdir(parent) or filesystemType(parent) not in RAMFILESYSTEMS:
+        return False
+    try:
+        os.makedirs(pathname)
+    except OSError:
+        pass # exists already, or not allowed. Test below.
+    return os.path.isdir(pathname) and os.access(pathname, os.W_OK | os.X_OK)
+
+_checkedLockRoots = set()
+
+def checkLockRoot(root):
+    """Warns (only once per root) if 'root' is on slow or network storage.
+       Returns 'root' unchanged."""
+    if root not in _checkedLockRoots:
+        _checkedLockRoots.add(root)
+        fstype = filesystemType(root)
+        if isSlowFilesystem(fstype):
+            warnings.warn("lockbydir: lock root '%s' is on a '%s' filesystem. "
+                          "Locking will be slow. Better use a RAM disk." 
+                          % (root or os.getcwd(), fstype))
+    return root
+
+_defaultLockRoot = []
+
+def defaultLockRoot():
+    """Lock root for all DLocks which do not set their own LOCKROOT.
+    
+       The first usable of LOCKROOTCANDIDATES (a writable tmpfs), 
+       or if there is none, fall back to "" = the current directory
+       (with a warning, because other processes may not be started there).
+       Chosen only once per process."""
+    if not _defaultLockRoot:
+        root = ""
+        if os.name != "nt":
+            for candidate in LOCKROOTCANDIDATES:
+                candidate = os.path.expandvars(candidate % {"uid": os.getuid()})
+                if "$" in candidate: 
+                    continue # environment variable not set
+                if usableRamLockRoot(candidate):
+                    root = candidate
+                    break
+            if not root:
+                warnings.warn("lockbydir: no writable RAM disk for the lock root, "
+                              "using the current directory '%s'. Better set "
+                              "LOCKROOT." % os.getcwd())
+        _defaultLockRoot.append( checkLockRoot(root) )
+    return _defaultLockRoot[0]
+
+
 ## locking implemented as (success of) directory creation and removal.
 ## read more at 
 ##   http://en.wikipedia.org/wiki/File_locking#Lock_files
@@ -130,6 +247,7 @@ except ImportError:
     from exceptions import OSError
 
 def mkdir_ReturnWhetherSuccessful(pathname):
+    "mkdir. Missing parent dirs (e.g. of a lock name 'sub/x') are created first."
     try:
         os.mkdir(pathname)
         return True
@@ -144,9 +262,29 @@ def mkdir_ReturnWhetherSuccessful(pathname):
         ##   or when full:                       28, OSError(28, 'No space left on device')
         if e.errno in (17,13,71,28): 
             return False
+        elif e.errno == errno.ENOENT and makeParentDirs(pathname):
+            return mkdir_ReturnWhetherSuccessful(pathname)
         else: 
             raise e
+
+def makeParentDirs(pathname):
+    "Create the missing parent dirs of 'pathname'. Returns whether any were missing."
+    parent = os.path.dirname(pathname)
+    if not parent or os.path.isdir(parent):
+        return False
+    try:
+        os.makedirs(parent)
+    except OSError:
+        pass # concurrently created by someone else, or not allowed. Test below.
+    return os.path.isdir(parent)
     
+def listdir_OrEmpty(pathname):
+    "names in dir, or [] if it does not exist (yet)"
+    try:
+        return os.listdir(pathname)
+    except OSError:
+        return []
+
 def rmdir_ReturnWhetherSuccessfullyRemoved(pathname):
     try:
         os.rmdir(pathname)
@@ -158,13 +296,132 @@ def rmdir_ReturnWhetherSuccessfullyRemoved(pathname):
         ##          or when concurrent:              13 WindowsError(5, 'Access is denied')
         ## Linux:   <type 'exceptions.OSError'>       2 [Errno 2] No such file or directory: 'testing' 
         ##   or when concurrent & virtualbox         71, OSError(71, 'Protocol error')
-        if e.errno in (2,13,71): 
+        ##   or when not empty:                      ENOTEMPTY (39 Linux, 41 Windows)
+        if e.errno in (2,13,71,errno.ENOTEMPTY): 
+            return False
+        else: 
+            raise e
+
+
+## small files next to the lockdirs, e.g. for results or shared state.
+## Readers must never see a half-written file, so: write a temporary file, 
+## then rename it. (Atomic on Linux. On Windows the old file must be removed 
+## first, so there is a tiny moment without file.)
+
+def writeFileAtomically(pathname, data):
+    "Write string 'data' into a temporary file, then rename it to 'pathname'."
+    tmpname = "%s.%d-%06x.tmp" % (pathname, os.getpid(), random.getrandbits(24))
+    with open(tmpname, "wb") as f:
+        f.write(data)
+    try:
+        if os.name == "nt":
+            remove_ReturnWhetherSuccessfullyRemoved(pathname)
+        os.rename(tmpname, pathname)
+    except:
+        remove_ReturnWhetherSuccessfullyRemoved(tmpname)
+        raise
+
+def readFile(pathname):
+    "whole content of file as string, or None if it does not exist (anymore)"
+    try:
+        with open(pathname, "rb") as f:
+            return f.read()
+    except (IOError, OSError):
+        return None
+
+def remove_ReturnWhetherSuccessfullyRemoved(pathname):
+    "remove a file. False if there was none."
+    try:
+        os.remove(pathname)
+        return True
+    except OSError as e:
+        if e.errno in (2,13): 
             return False
         else: 
             raise e
 
 
-########## 2 tests: ###########################################
+## doorbells: waking up waiting processes, without polling.
+## A waiter creates a named pipe (FIFO) in a doorbell dir, and sleeps in
+## select() on it. Ringing = writing 1 byte into the FIFOs in that dir. 
+## Without named pipes (Windows) the waiters just sleep DOORBELLPOLL seconds.
+
+def doorbellInstall(dirpath):
+    """Create my FIFO in 'dirpath' (created if needed). 
+       Returns the doorbell, for doorbellWait() and doorbellRemove().
+       Install it BEFORE checking your condition, then no ring is lost."""
+    if not hasattr(os, "mkfifo"):
+        return None
+    if not os.path.isdir(dirpath):
+        try: os.makedirs(dirpath)
+        except OSError: pass # concurrently created by someone else
+    pathname = os.path.join(dirpath, "%.6f-%d-%06x%s" % (time.time(), 
+                            os.getpid(), random.getrandbits(24), DOORBELLEXTENSION))
+    os.mkfifo(pathname)
+    readfd = os.open(pathname, os.O_RDONLY | os.O_NONBLOCK)
+    # my own writer keeps select() from seeing 'end of file' all the time:
+    writefd = os.open(pathname, os.O_WRONLY | os.O_NONBLOCK)
+    return (pathname, readfd, writefd)
+
+def doorbellWait(doorbell, secs):
+    """Sleep until rung, but max 'secs' seconds. 
+       Returns True if rung (or perhaps rung, without FIFOs). False if not,
+       also if interrupted by a signal: callers wait again for the rest."""
+    if doorbell is None:
+        time.sleep(max(0, min(secs, DOORBELLPOLL)))
+        return secs > DOORBELLPOLL
+    try:
+        readable, _, _ = select.select([doorbell[1]], [], [], max(0, secs))
+    except select.error as e:
+        if e.args[0] == errno.EINTR:
+            return False # interrupted by a signal, not rung
+        raise
+    if readable:
+        try: os.read(doorbell[1], 512)
+        except OSError: pass
+        return True
+    return False
+
+def doorbellRemove(doorbell):
+    "Uninstall my doorbell. No more rings."
+    if doorbell is None:
+        return
+    pathname, readfd, writefd = doorbell
+    remove_ReturnWhetherSuccessfullyRemoved(pathname)
+    os.close(writefd)
+    os.close(readfd)
+
+def doorbellRing(dirpath, n = None):
+    """Wake up the oldest 'n' waiters in 'dirpath', or all if n is None.
+       Returns how many were rung. Removes doorbells of dead processes."""
+    try:
+        entries = sorted(os.listdir(dirpath))
+    except OSError:
+        return 0
+    rung = 0
+    for entry in entries:
+        if n is not None and rung >= n:
+            break
+        if not entry.endswith(DOORBELLEXTENSION):
+            continue
+        pathname = os.path.join(dirpath, entry)
+        try:
+            fd = os.open(pathname, os.O_WRONLY | os.O_NONBLOCK)
+        except OSError as e:
+            if e.errno == errno.ENXIO: # no reader, so its process is dead
+                remove_ReturnWhetherSuccessfullyRemoved(pathname)
+            continue
+        try:
+            os.write(fd, "!")
+            rung += 1
+        except OSError:
+            rung += 1 # EAGAIN: pipe full, so it has been rung plenty
+        finally:
+            os.close(fd)
+    return rung
+
+
+########## 3 tests: ###########################################
 
 def test_mkdirRmdir():
     "Should print: done True True False True False False."
@@ -224,12 +481,23 @@ def test_mkdirRmdirConcurrent(n):
 
     print Q
 
+def test_lockRoot():
+    "Where would the lockdirs be created? And how fast is that?"
+    
+    root = defaultLockRoot()
+    print "default lock root = '%s'" % root,
+    print "(filesystem type: %s)" % filesystemType(root)
+    print "current directory = '%s'" % os.getcwd(),
+    print "(filesystem type: %s)" % filesystemType(os.curdir)
+
 def tests():
     print "\nlockbydir.py OS-level routines. Tests."
     print "\nTest 1:\n"
     test_mkdirRmdir()
     print "\nTest 2:\n"
     test_mkdirRmdirConcurrent(10)
+    print "\nTest 3:\n"
+    test_lockRoot()
     
     
     
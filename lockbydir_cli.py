@@ -0,0 +1,229 @@
+'''
+lockbydir_cli.py - Inspection tool: live view of the locks in a lock root.
+
+@requires: lockbydir.py         # defaults, extensions
+@requires: lockbydir_OS.py      # lockdir OS-level routines
+
+@call:     python -m lockbydir list  [--root DIR] [--timeout SECS]
+@call:     python -m lockbydir watch [--root DIR] [--timeout SECS] [--interval SECS]
+@call:     python -m lockbydir profile [--root DIR] [--top N]
+@return:   stdout
+
+@summary
+
+Instead of 'ls -la *.lockdir' when latency spikes:
+
+list:  All lockdirs in the lock root, with their age vs TIMEOUT, whether
+       expired, the holder (if recorded, see DLock.RECORDHOLDER), and the
+       number of waiters (every looping waiter registers, see 
+       DLock.registerWaiter). Hierarchical locks (lockbydir_hierarchy.py)
+       are listed per node, as "db/table", with the modes held on it.
+
+watch: The same, refreshed every --interval seconds, plus per lock:
+       acquisitions per second, and hand-off latency (from release to the
+       next acquisition). Exact if the holders record them (RECORDHOLDER). 
+       Otherwise only sampled estimates: An acquisition is seen as a new 
+       lockdir date, so at most 1 per refresh. The hand-off latency is then
+       the time from when the old holder was last seen, to the date of the 
+       new lockdir, so an upper limit.
+
+profile: The worst holders and waiters per lock, by call site, as recorded
+       by the profiler. See lockbydir_profiler.py
+
+Each refresh is 1 scan of the lock root, plus 1 stat per lockdir, plus 1 scan
+per waiting dir, plus 1 read per holder file, plus 1 scan per node dir and
+1 stat per marker of hierarchical locks. Nothing is written, nothing
+is locked. So it can run against a hot lock root.
+'''
+
+import os, sys, time, argparse
+
+from lockbydir import TIMEOUT, WAITINGEXTENSION, HOLDEREXTENSION, parseHolder
+from lockbydir_OS import LOCKDIREXTENSION, defaultLockRoot, listdir_OrEmpty, readFile
+from lockbydir_hierarchy import NODEDIREXTENSION, COMPATIBLE
+
+
+def scan(root):
+    """One scan of the lock root. Returns dict lockname -> dict with:
+       held (lockdir exists), mtime, holder (as recorded), waiters.
+       Nodes of hierarchical locks also have: modes (of their markers)."""
+    entries = listdir_OrEmpty(root)
+    present = set(entries)
+    locks = {}
+    for entry in entries:
+        if entry.endswith(NODEDIREXTENSION):
+            scanNode(os.path.join(root, entry), entry[:-len(NODEDIREXTENSION)], locks)
+            continue
+        if entry.endswith(LOCKDIREXTENSION):
+            name = entry[:-len(LOCKDIREXTENSION)]
+        elif entry.endswith(HOLDEREXTENSION):
+            name = entry[:-len(HOLDEREXTENSION)]
+        else:
+            continue
+        if name in locks:
+            continue
+        held, mtime = name + LOCKDIREXTENSION in present, None
+        if held:
+            try:
+                mtime = os.stat(os.path.join(root, name + LOCKDIREXTENSION)).st_mtime
+            except OSError:
+                held = False # unlocked meanwhile
+        holder, waiters = {}, 0
+        if name + HOLDEREXTENSION in present:
+            holder = parseHolder(readFile(os.path.join(root, name + HOLDEREXTENSION)))
+        if name + WAITINGEXTENSION in present:
+            waiters = len(listdir_OrEmpty(os.path.join(root, name + WAITINGEXTENSION)))
+        locks[name] = {"held": held, "mtime": mtime, "holder": holder, 
+                       "waiters": waiters}
+    return locks
+
+def scanNode(nodedir, name, locks):
+    """Adds the node 'name' of a hierarchical lock, and its child nodes.
+       A node is held while it has markers; mtime is of the newest one."""
+    modes, mtime = [], None
+    for entry in listdir_OrEmpty(nodedir):
+        if entry.endswith(NODEDIREXTENSION):
+            scanNode(os.path.join(nodedir, entry),
+                     name + "/" + entry[:-len(NODEDIREXTENSION)], locks)
+            continue
+        mode = entry.partition(".")[0]
+        if mode not in COMPATIBLE:
+            continue # the guard
+        try:
+            markerTime = os.stat(os.path.join(nodedir, entry)).st_mtime
+        except OSError:
+            continue # unlocked meanwhile
+        modes.append(mode)
+        mtime = max(mtime, markerTime)
+    locks[name] = {"held": bool(modes), "mtime": mtime, "holder": {},
+                   "waiters": 0, "modes": sorted(modes)}
+
+def currentHolder(info):
+    "the recorded holder, if it recorded the current lockdir"
+    holder = info["holder"]
+    if (info["held"] and "released" not in holder and 
+        abs(float(holder.get("acquired", 0)) - info["mtime"]) < 1):
+        return holder
+    return {}
+
+def formatLocks(locks, now, timeout, rates = None):
+    """table of the locks, as list of lines. 
+       Locks which are not held are only shown with rates."""
+    header = "%-30s %8s %8s %-8s %7s" % ("NAME", "AGE", "TIMEOUT", "STATUS", "WAITERS")
+    if rates is not None:
+        header += " %8s %9s" % ("ACQ/S", "HANDOFF")
+    lines = [header + "  HOLDER"]
+    for name in sorted(locks):
+        info = locks[name]
+        if not info["held"] and rates is None:
+            continue
+        holder = currentHolder(info)
+        lockTimeout = float(holder.get("timeout", timeout))
+        if info["held"]:
+            age = now - info["mtime"]
+            status = "EXPIRED" if age > lockTimeout else "held"
+            line = "%-30s %7.1fs" % (name[-30:], age)
+        else:
+            status = "free"
+            line = "%-30s %8s" % (name[-30:], "-")
+        line += " %7gs %-8s %7d" % (lockTimeout, status, info["waiters"])
+        if rates is not None:
+            acquisitions, handoff = rates.get(name, (0, None))
+            line += " %8.1f %9s" % (acquisitions,
+                    "-" if handoff is None else "%.4fs" % handoff)
+        if info.get("modes"):
+            line += "  modes=%s" % ",".join(info["modes"])
+        if holder:
+            line += "  pid=%s host=%s thread=%s" % (holder.get("pid"),
+                    holder.get("host"), holder.get("thread"))
+        lines.append(line)
+    if len(lines) == 1:
+        lines.append("(no locks)")
+    return lines
+
+
+class Watcher:
+    """Compares consecutive scans: acquisitions per second, hand-off latency.
+       Exact if recorded by the holders (DLock.RECORDHOLDER), else sampled."""
+
+    def __init__(self):
+        self.lastSeen = {} # lockname -> (mtime, seq, when last seen)
+        self.lastScan = None
+
+    def update(self, locks, now):
+        "Returns dict lockname -> (acquisitions per second, handoff or None)"
+        rates = {}
+        interval = (now - self.lastScan) if self.lastScan else None
+        for name, info in locks.items():
+            seq = info["holder"].get("seq")
+            mtime, seen = info["mtime"], self.lastSeen.get(name)
+            acquisitions, handoff = 0, None
+            if seq is not None:
+                if seen is not None and seen[1] is not None:
+                    acquisitions = int(seq) - int(seen[1])
+                if acquisitions and "handoff" in info["holder"]:
+                    handoff = float(info["holder"]["handoff"])
+            elif mtime is not None and (seen is None or seen[0] != mtime):
+                acquisitions = 1 # at least
+                if seen is not None and seen[0] is not None:
+                    handoff = max(0, mtime - seen[2]) # at most
+            self.lastSeen[name] = (mtime, seq, now)
+            if interval:
+                rates[name] = (acquisitions / interval, handoff)
+        self.lastScan = now
+        return rates
+
+
+def listLocks(root, timeout):
+    now = time.time()
+    print "lock root: %s    %s" % (root or os.getcwd(), time.strftime("%H:%M:%S"))
+    for line in formatLocks(scan(root), now, timeout):
+        print line
+
+def watchLocks(root, timeout, interval, count = None):
+    W = Watcher()
+    refreshes = 0
+    while count is None or refreshes < count:
+        locks, now = scan(root), time.time()
+        rates = W.update(locks, now)
+        print "\nlock root: %s    %s" % (root or os.getcwd(), time.strftime("%H:%M:%S"))
+        for line in formatLocks(locks, now, timeout, rates):
+            print line
+        sys.stdout.flush()
+        refreshes += 1
+        if count is None or refreshes < count:
+            time.sleep(interval)
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(prog = "python -m lockbydir",
+                description = "Show the DLocks in a lock root.")
+    parser.add_argument("command", choices = ["list", "watch", "profile"])
+    parser.add_argument("--root", default = None,
+                        help = "lock root (default: as chosen by DLock)")
+    parser.add_argument("--timeout", type = float, default = TIMEOUT,
+                        help = "TIMEOUT, if not recorded by the holder (default: %(default)s)")
+    parser.add_argument("--interval", type = float, default = 1.0,
+                        help = "seconds between refreshes of 'watch' (default: %(default)s)")
+    parser.add_argument("--count", type = int, default = None,
+                        help = "stop 'watch' after this many refreshes")
+    parser.add_argument("--top", type = int, default = 5,
+                        help = "call sites per lock, for 'profile' (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    root = defaultLockRoot() if args.root is None else args.root
+    try:
+        if args.command == "list":
+            listLocks(root, args.timeout)
+        elif args.command == "profile":
+            import lockbydir_profiler
+            for line in lockbydir_profiler.report(root, args.top):
+                print line
+        else:
+            watchLocks(root, args.timeout, args.interval, args.count)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,218 @@
+'''
+lockbydir_combining.py - Flat combining: one lock holder runs the operations of all waiters.
+
+@requires: lockbydir.py         # the DLock class
+@requires: lockbydir_OS.py      # lockdir OS-level routines
+
+@call:     done, result = Combiner( "name" ).execute( fn, arg1, arg2 )
+@return:   (True, fn(arg1, arg2)), or (False, None) if PATIENCE was gone
+
+@summary
+
+When many processes each need a tiny critical section (e.g. appending one
+line to a shared file), most time goes into DLock hand-offs, not into the work.
+
+Combining mode: Instead of waiting for the lock, each caller drops its
+operation, pickled, into a spool dir next to the lockdir:
+
+    <lockroot>/<name>.spool/req.<token>
+
+Whoever gets the lock becomes the 'combiner', and runs a whole batch of
+spooled operations under this one acquisition. For each, it writes a
+completion file done.<token>, with the result (or the exception), which the
+waiting caller picks up. So N lock round-trips become roughly one.
+
+A caller writes its request as tmp.<token> first, and renames it to
+req.<token> when complete, so a combiner never sees a half-written one.
+A combiner claims a request by renaming it to run.<token>. A caller whose
+PATIENCE is gone withdraws its request by removing it; if that fails, the
+request was already claimed, so the caller waits (at most TIMEOUT) for its
+completion file. Leftovers of crashed processes (tmp.*, run.*, done.*
+older than ORPHANTIMEOUTS * TIMEOUT) are removed by the next combiner.
+
+fn, its arguments, and its result must be picklable, so fn must be a module
+level function, known to all processes. Best for small idempotent operations.
+'''
+
+# maximum number of operations which a combiner runs under one acquisition:
+BATCHSIZE = 100
+
+# spool entries (not requests) older than this many TIMEOUTs are leftovers
+# of crashed processes, and removed by a combiner:
+ORPHANTIMEOUTS = 3
+
+# spool dir extension:
+SPOOLEXTENSION = ".spool"
+
+import os, time, random
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from lockbydir import DLock
+from lockbydir_OS import writeFileAtomically, readFile, remove_ReturnWhetherSuccessfullyRemoved
+from lockbydir_OS import pathAgeInSeconds
+
+
+class Combiner:
+    """Runs operations under the DLock 'name', combined in batches.
+       Lock parameters are those of self.L (a DLock); change them there."""
+
+    def __init__(self, name):
+        self.name = name
+        self.L = DLock(name)
+        self.BATCHSIZE = BATCHSIZE
+        self.batches = 0      # how often this instance was the combiner
+        self.operations = 0   # how many operations it ran for everybody
+
+    def execute(self, fn, *args, **kwargs):
+        """Have fn(*args, **kwargs) run under the lock, by me or by the combiner.
+
+           Returns (True, result).
+           Returns (False, None) if it did not run within PATIENCE.
+           Raises the exception if fn raised one."""
+
+        spool = self.spoolDir()
+        token = "%.6f-%d-%06x" % (time.time(), os.getpid(), random.getrandbits(24))
+        pending = os.path.join(spool, "tmp." + token)
+        request = os.path.join(spool, "req." + token)
+        done = os.path.join(spool, "done." + token)
+
+        operation = pickle.dumps( (fn, args, kwargs), pickle.HIGHEST_PROTOCOL )
+        with open(pending, "wb") as f:
+            f.write(operation)
+        os.rename(pending, request) # complete: now visible for combiners
+
+        L = self.L
+        L.startedWaitingTime = time.time()
+        deadline = None
+
+        while True:
+            data = readFile(done)
+            if data is not None:
+                remove_ReturnWhetherSuccessfullyRemoved(done)
+                return unpackCompletion(data)
+
+            if L.locking():
+                try:
+                    self.combine(spool)
+                finally:
+                    L.unlocking()
+                continue # now my completion file should be there
+
+            if deadline is None and not L.stillPatience():
+                if remove_ReturnWhetherSuccessfullyRemoved(request):
+                    return False, None # withdrawn, never ran
+                deadline = time.time() + L.TIMEOUT # claimed, running soon
+            if deadline is not None and time.time() > deadline:
+                return False, None # combiner died, unknown whether it ran
+
+            L.removeIfTimedOut()
+            time.sleep(L.CHECKEVERYXSECONDS)
+
+    # end PUBLIC functions.
+    # begin PRIVATE functions. Usually no need to call them:
+
+    def spoolDir(self):
+        "dir for requests and completions, next to the lockdir. Created if needed."
+        spool = os.path.join(self.L.lockRoot(), self.name + SPOOLEXTENSION)
+        if not os.path.isdir(spool):
+            try: os.makedirs(spool)
+            except OSError: pass # concurrently created by someone else
+        return spool
+
+    def combine(self, spool):
+        """Run a batch of spooled requests, oldest first. Only with the lock!
+           Stops early before half of TIMEOUT is used up."""
+        self.batches += 1
+        entries = os.listdir(spool)
+        requests = sorted(entry for entry in entries if isRequest(entry))
+        self.removeOrphans(spool, entries)
+
+        for entry in requests[:self.BATCHSIZE]:
+            if time.time() - self.L.lockingTime > self.L.TIMEOUT / 2.0:
+                break
+            token = entry[len("req."):]
+            running = os.path.join(spool, "run." + token)
+            try:
+                os.rename(os.path.join(spool, entry), running) # claim
+            except OSError:
+                continue # withdrawn by its caller
+            data = readFile(running)
+            writeFileAtomically(os.path.join(spool, "done." + token),
+                                runOperation(data))
+            remove_ReturnWhetherSuccessfullyRemoved(running)
+            self.operations += 1
+
+    def removeOrphans(self, spool, entries):
+        "remove tmp.*, run.*, done.* (and any .tmp) left by crashed processes"
+        maxAge = ORPHANTIMEOUTS * self.L.TIMEOUT
+        for entry in entries:
+            if isRequest(entry):
+                continue # runs anyway
+            pathname = os.path.join(spool, entry)
+            if pathAgeInSeconds(pathname) > maxAge:
+                remove_ReturnWhetherSuccessfullyRemoved(pathname)
+
+
+def isRequest(entry):
+    "req.<token>, complete. Not a temporary file of writeFileAtomically"
+    return entry.startswith("req.") and not entry.endswith(".tmp")
+
+def runOperation(data):
+    "unpickle and run one operation, return the pickled completion"
+    try:
+        fn, args, kwargs = pickle.loads(data)
+        completion = ("result", fn(*args, **kwargs))
+    except Exception as e:
+        completion = ("exception", e)
+    try:
+        return pickle.dumps(completion, pickle.HIGHEST_PROTOCOL)
+    except Exception: # result or exception not picklable
+        return pickle.dumps( ("exception", RuntimeError(repr(completion[1]))),
+                             pickle.HIGHEST_PROTOCOL)
+
+def unpackCompletion(data):
+    "(True, result), or raise the exception of the operation"
+    kind, value = pickle.loads(data)
+    if kind == "exception":
+        raise value
+    return True, value
+
+
+def appendLine(filename, line):
+    "example operation: tiny critical section"
+    with open(filename, "a") as f:
+        f.write(line + "\n")
+        time.sleep(0.005) # pretend some work
+    return len(line)
+
+def testCombining(n = 50):
+    "n threads append 1 line each. Should need far fewer than n acquisitions."
+
+    import threading, tempfile
+    filename = os.path.join(tempfile.gettempdir(), "combiningExample.txt")
+    remove_ReturnWhetherSuccessfullyRemoved(filename)
+    combiners = [Combiner("combiningExample") for _ in range(n)]
+    go = threading.Event()
+
+    def worker(i):
+        go.wait() # all at once
+        combiners[i].execute(appendLine, filename, "line %d" % i)
+
+    t = [threading.Thread(target = worker, args = (i,)) for i in range(n)]
+    for thr in t: thr.start()
+    go.set()
+    for thr in t: thr.join()
+
+    with open(filename) as f:
+        lines = f.readlines()
+    print "%d operations, %d lines written," % (n, len(lines)),
+    print "by %d lock acquisitions." % sum(C.batches for C in combiners)
+    remove_ReturnWhetherSuccessfullyRemoved(filename)
+
+
+if __name__ == '__main__':
+    testCombining()
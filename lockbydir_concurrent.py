@@ -51,9 +51,6 @@ My github For feature requests, ideas, suggestions, appraisal, criticism:
 
 RUN_EXAMPLE = 1  # 1 or 2
 
-RAMDISK = "/ramcache/"   # see lockbydir.print_Ramdisk_Manual  
-RAMDISK = ""             # if you have such a ramdisk, uncomment this line
-
 from lockbydir import DLock, getInfoLogger, TIMEOUT, print_Ramdisk_Manual
 
 ######################################################################
@@ -210,7 +207,7 @@ def massiveNumberOfUsers(n, secs):
        consecutive differences, to see if a lock violation happened.
     """
     
-    lockname = RAMDISK + "oneNarrowBedForManySleepers"
+    lockname = "oneNarrowBedForManySleepers" # on a RAM disk if there is one
     timestamps = []
     
     Log = getInfoLogger('[thrId=%(thread).5d]') # nice printing with timestamp
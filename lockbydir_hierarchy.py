@@ -0,0 +1,255 @@
+'''
+lockbydir_hierarchy.py - Hierarchical DLocks with intention modes.
+
+@requires: lockbydir.py         # the DLock class
+@requires: lockbydir_OS.py      # lockdir OS-level routines
+
+@call:     L = HDLock( "db/table/row", S ) # then like DLock
+@return:   class with .LoopWhileLocked_ThenLocking() and .unlocking()
+
+@summary
+
+Lock whole tables at some times, and single rows at others - concurrently.
+
+Slash separated lock names are mapped onto nested node dirs in the lock root:
+
+    "db/table/row"   -->   db.hlockdir/table.hlockdir/row.hlockdir
+
+A lock on a node is a marker dir "<MODE>.<token>" inside the node dir.
+Before a node is locked in S (shared) or X (exclusive) mode, all its ancestors
+are locked in IS (intention-shared) or IX (intention-exclusive) mode:
+
+               IS    IX    S     X      (compatibility of modes,
+         IS   yes   yes   yes    -       held by different HDLocks)
+         IX   yes   yes    -     -
+         S    yes    -    yes    -
+         X     -     -     -     -
+
+So row locks "db/t/1" (X) and "db/t/2" (X) run in parallel, as they only need
+IX on "db" and "db/t". But "db/t" (X) excludes everyone else below "db/t".
+
+Markers time out after TIMEOUT, exactly like lockdirs. Waiting is limited by
+PATIENCE. The short check-then-mkdir of a marker is protected by a normal
+DLock (the 'guard') inside each node dir.
+
+Node dirs are created when first needed, and never removed.
+
+Of the DLock features, HDLock supports TIMEOUT, PATIENCE, CHECKEVERYXSECONDS,
+LOCKROOT, REMOVETIMEDOUT, release at exit (and on signals), and the
+inspection tool ('python -m lockbydir list' shows nodes as "db/table", with
+the modes held). Not supported: priorities, WATCHDOG, DETECTDEADLOCKS,
+RECORDHOLDER, MAXWAITERS, MAXPREDICTEDWAIT. Setting them raises ValueError
+when locking, instead of being silently ignored.
+'''
+
+# modes:
+IS, IX, S, X = "IS", "IX", "S", "X"
+
+# which modes (of others) can be held together with my mode:
+COMPATIBLE = { IS: (IS, IX, S),
+               IX: (IS, IX),
+               S:  (IS, S),
+               X:  () }
+
+# the mode that an ancestor node must be locked in, for each mode:
+INTENTION = { IS: IS, IX: IX, S: IS, X: IX }
+
+# node dir extension:
+NODEDIREXTENSION = ".hlockdir"
+
+# the guard is held only during the check-then-mkdir of one marker:
+GUARDNAME = "guard"
+GUARDTIMEOUT = 1
+
+# DLock options which HDLock does not implement, with their 'off' values:
+UNSUPPORTED = { "WATCHDOG": None, "DETECTDEADLOCKS": False,
+                "RECORDHOLDER": False, "MAXWAITERS": None,
+                "MAXPREDICTEDWAIT": None }
+
+import os, time, random, thread
+
+from lockbydir import DLock, registerHeld, unregisterHeld
+from lockbydir_OS import pathAgeInSeconds, ERROR
+from lockbydir_OS import mkdir_ReturnWhetherSuccessful, rmdir_ReturnWhetherSuccessfullyRemoved
+
+
+class HDLock (DLock):
+    """A DLock on a node "a/b/c" of a hierarchy, in mode IS, IX, S, or X.
+
+       Same TIMEOUT, PATIENCE, CHECKEVERYXSECONDS, LOCKROOT as DLock.
+       The DLock options in UNSUPPORTED must stay off, see checkSupported."""
+
+    def __init__(self, name, mode = X):
+        DLock.__init__(self, name)
+        if mode not in COMPATIBLE:
+            raise ValueError("mode must be one of IS, IX, S, X, not %r" % mode)
+        self.mode = mode
+        self.token = "%d-%d-%06x" % (os.getpid(), thread.get_ident(),
+                                     random.getrandbits(24))
+        self.markers = []
+
+    def LoopWhileLocked_ThenLocking(self, priority = None):
+        """Wait until all nodes on the path can be locked, then lock them.
+           Returns True if locking succeeded, False if PATIENCE ran out.
+           Same signature as DLock, but without priorities."""
+        if priority is not None:
+            raise ValueError("HDLock does not support priority (got %r)" % (priority,))
+        self.startedWaitingTime = time.time()
+        acquired = self.locking()
+
+        while (not acquired and self.stillPatience()):
+            time.sleep (self.CHECKEVERYXSECONDS)
+            acquired = self.locking()
+
+        return acquired
+
+    def unlocking(self):
+        """Remove my markers, bottom up, if not timed-out yet.
+           Returns True if that happened."""
+        if self.lockingTime == None or self.lockingPid != os.getpid():
+            return False # not held, or forked: the parent owns it
+
+        unregisterHeld(self)
+        stillMine = (time.time() - self.lockingTime) < self.TIMEOUT
+        markers, self.markers, self.lockingTime = self.markers, [], None
+        if not stillMine:
+            return False # timed out, others may have removed them already
+
+        for marker in reversed(markers):
+            rmdir_ReturnWhetherSuccessfullyRemoved(marker)
+        return True
+
+    # end PUBLIC functions.
+    # begin PRIVATE functions. Usually no need to call them:
+
+    def checkSupported(self):
+        "Raises ValueError if a DLock option is set which HDLock ignores."
+        for option, off in sorted(UNSUPPORTED.items()):
+            if getattr(self, option) != off:
+                raise ValueError("HDLock does not support %s (got %r)" %
+                                 (option, getattr(self, option)))
+
+    def nodes(self):
+        "list of (nodedir, mode), from the top of the hierarchy down to me"
+        parts = [part for part in self.name.split("/") if part]
+        path, nodes = self.lockRoot(), []
+        for i, part in enumerate(parts):
+            path = os.path.join(path, part + NODEDIREXTENSION)
+            last = (i == len(parts) - 1)
+            nodes.append( (path, self.mode if last else INTENTION[self.mode]) )
+        return nodes
+
+    def dirname(self):
+        "the node dir of this lock name"
+        return self.nodes()[-1][0]
+
+    def conflicts(self, nodedir, mode):
+        """Is there a marker of someone else, not timed out,
+           which is incompatible with 'mode'? Removes timed-out markers."""
+        try:
+            entries = os.listdir(nodedir)
+        except OSError:
+            return False # node dir does not exist yet, so nothing locked
+
+        for entry in entries:
+            if entry.endswith(NODEDIREXTENSION) or entry.endswith(self.LOCKDIREXTENSION):
+                continue # child node dirs, and the guard
+            theirMode, _, token = entry.partition(".")
+            if theirMode not in COMPATIBLE or token == self.token:
+                continue # my own
+            marker = os.path.join(nodedir, entry)
+            age = pathAgeInSeconds(marker)
+            if age == ERROR:
+                continue # just removed
+            if age > self.TIMEOUT:
+                if self.REMOVETIMEDOUT:
+                    rmdir_ReturnWhetherSuccessfullyRemoved(marker)
+                continue
+            if theirMode not in COMPATIBLE[mode]:
+                return True
+        return False
+
+    def isLocked(self):
+        "Would my mode conflict with locks held by others, on any node?"
+        return any(self.conflicts(nodedir, mode) for nodedir, mode in self.nodes())
+
+    def guard(self, nodedir):
+        "the DLock protecting the markers of one node"
+        G = DLock(GUARDNAME)
+        G.LOCKROOT = nodedir
+        G.TIMEOUT = GUARDTIMEOUT
+        G.CHECKEVERYXSECONDS = self.CHECKEVERYXSECONDS
+        G.PATIENCE = max(0, self.PATIENCE - (time.time() - self.startedWaitingTime))
+        for option, off in UNSUPPORTED.items():
+            setattr(G, option, off) # the guard is too short-lived for them
+        return G
+
+    def lockingNode(self, nodedir, mode):
+        """Create my marker in 'nodedir', if 'mode' is compatible with others.
+           Returns the marker path, or None if not possible now."""
+        if not os.path.isdir(nodedir):
+            try: os.makedirs(nodedir)
+            except OSError: pass # concurrently created by someone else
+
+        G = self.guard(nodedir)
+        if not (G.locking() or G.LoopWhileLocked_ThenLocking()):
+            return None
+        try:
+            if self.conflicts(nodedir, mode):
+                return None
+            marker = os.path.join(nodedir, "%s.%s" % (mode, self.token))
+            if not mkdir_ReturnWhetherSuccessful(marker):
+                return None
+            return marker
+        finally:
+            G.unlocking()
+
+    def locking(self):
+        """One attempt to lock all nodes, top down. All or nothing.
+           Returns True if locking succeeded."""
+        self.checkSupported()
+        self.startWaiting()
+
+        markers = []
+        for nodedir, mode in self.nodes():
+            marker = self.lockingNode(nodedir, mode)
+            if marker is None:
+                for taken in reversed(markers):
+                    rmdir_ReturnWhetherSuccessfullyRemoved(taken)
+                return False
+            markers.append(marker)
+
+        self.markers = markers
+        self.lockingTime = self.acquiredTime = time.time()
+        self.lockingPid = os.getpid()
+        self.startedWaitingTime = None
+        registerHeld(self) # released at exit, see lockbydir.releaseAll
+        return True
+
+
+def testHDLock():
+    "Rows in parallel, a table lock excludes them. Should print True/False pairs."
+
+    row1, row2 = HDLock("example/table/row1", X), HDLock("example/table/row2", X)
+    print "row1 X, row2 X:         ", row1.locking(), row2.locking(), "(parallel)"
+
+    table = HDLock("example/table", X)
+    table.PATIENCE = 1
+    print "table X while rows held:", table.LoopWhileLocked_ThenLocking(),
+    print "(after waiting PATIENCE = 1)"
+
+    print "unlocking rows:         ", row1.unlocking(), row2.unlocking()
+    print "table X:                ", table.LoopWhileLocked_ThenLocking()
+
+    reader = HDLock("example/table/row1", S)
+    reader.PATIENCE = 1
+    print "row1 S while table X:   ", reader.LoopWhileLocked_ThenLocking()
+    print "unlocking table:        ", table.unlocking()
+
+    readers = [HDLock("example/table", S) for _ in range(2)] + [reader]
+    print "table S, S, row1 S:     ", [R.locking() for R in readers], "(shared)"
+    print "unlocking all:          ", [R.unlocking() for R in readers]
+
+
+if __name__ == '__main__':
+    testHDLock()
@@ -0,0 +1,224 @@
+'''
+lockbydir_leader.py - Leader election with leases, so only one worker runs periodic jobs.
+
+@requires: lockbydir.py         # the DLock class
+@requires: lockbydir_OS.py      # lockdir OS-level routines, doorbells
+
+@call:     D = DLeader( "name", lease = 10, on_elected = f, on_demoted = g )
+@call:     D.run( job, period = 60 )   # or D.campaign() in your own loop
+@return:   class with .campaign() .run() .resign() .isLeader
+
+@summary
+
+Every uwsgi worker runs the same periodic maintenance, and each period all N
+workers wake up, stat the lockdir, and race on mkdir - only to skip the job.
+
+DLeader: Whoever creates the lockdir is the leader. It renews its lease by
+touching the lockdir (heartbeat), every lease/3 seconds. It records its
+lease in <name>.lease, next to the lockdir.
+
+Followers do not poll: they sleep until the lease expiry (lockdir date plus
+recorded lease), check once, and sleep again if it was renewed. So each
+follower wakes up once per lease, not once per period. When the leader
+resigns, it rings the followers' doorbells (see lockbydir_OS), so one of them
+takes over at once. If the leader dies, they take over after the lease.
+
+The leader also records in <name>.lease when its periodic job last ran. A
+new leader (after a resign, or a failover) schedules the job from then on,
+so it does not repeat the run which its predecessor just did.
+
+A leader which could not renew in time (e.g. its job ran too long) does not
+touch the lockdir anymore - it might already belong to a new leader - and
+is demoted. Jobs should therefore be shorter than 2/3 of the lease.
+'''
+
+# default lease, seconds:
+from lockbydir import TIMEOUT as LEASE
+
+# the leader renews after this fraction of the lease:
+RENEWFRACTION = 1 / 3.0
+
+# followers wake up at lease expiry plus up to this many seconds (random),
+# so that they do not all race at the same moment:
+JITTER = 0.05
+
+# extensions:
+LEASEEXTENSION = ".lease"
+FOLLOWERSEXTENSION = ".followers"
+
+import os, time, random
+
+from lockbydir import DLock, parseHolder
+from lockbydir_OS import ERROR, touchPath, writeFileAtomically, readFile
+from lockbydir_OS import doorbellInstall, doorbellWait, doorbellRemove, doorbellRing
+
+
+class DLeader:
+    """Leader election for 'name'. Callbacks get this DLeader as argument.
+       All instances with the same 'name' compete."""
+
+    def __init__(self, name, lease = LEASE, on_elected = None, on_demoted = None):
+        self.name = name
+        self.lease = lease
+        self.on_elected = on_elected
+        self.on_demoted = on_demoted
+        self.isLeader = False
+        self.renewedAt = None
+        self.lastRun = None # of the periodic job, by me or (as recorded) my predecessor
+        self.wakeups = 0 # how often this instance checked, as follower
+
+        self.L = DLock(name)
+        self.L.TIMEOUT = lease
+
+    def campaign(self):
+        """One step: The leader renews its lease, when due. A follower tries
+           to become leader. Returns whether I am the leader now."""
+        if self.isLeader:
+            if time.time() - self.renewedAt < self.lease * RENEWFRACTION:
+                return True
+            if self.renew():
+                return True
+            self.demoted()
+            return False
+
+        self.wakeups += 1
+        L = self.L
+        L.TIMEOUT = self.recordedLease()
+        if L.isLocked() or not L.locking(): # isLocked removes an expired one
+            return False
+        L.TIMEOUT = self.lease # now mine, not the previous leader's
+        self.isLeader = True
+        self.renewedAt = L.lockingTime
+        self.lastRun = self.recordedLastRun()
+        self.recordLease()
+        if self.on_elected:
+            self.on_elected(self)
+        return True
+
+    def run(self, job, period, duration = None):
+        """Run job() every 'period' seconds, but only while I am the leader.
+           Forever, or for 'duration' seconds. Then resign. 'period' counts
+           from the last run, also from one of the previous leader."""
+        end = None if duration is None else time.time() + duration
+        nextJob = lambda: (self.lastRun or 0) + period
+        try:
+            while end is None or time.time() < end:
+                if self.campaign() and time.time() >= nextJob():
+                    job()
+                    self.lastRun = time.time()
+                    self.recordLease()
+                wait = self.waitTime()
+                if self.isLeader:
+                    wait = min(wait, max(0, nextJob() - time.time()))
+                if end is not None:
+                    wait = min(wait, max(0, end - time.time()))
+                self.sleep(wait)
+        finally:
+            self.resign()
+
+    def resign(self):
+        "Give up leadership, and wake up the followers."
+        if not self.isLeader:
+            return False
+        self.L.lockingTime = self.renewedAt
+        released = self.L.unlocking()
+        self.demoted()
+        doorbellRing(self.followersDirname(), 1)
+        return released
+
+    # end PUBLIC functions.
+    # begin PRIVATE functions. Usually no need to call them:
+
+    def leaseFilename(self):
+        return os.path.join(self.L.lockRoot(), self.name + LEASEEXTENSION)
+
+    def followersDirname(self):
+        return os.path.join(self.L.lockRoot(), self.name + FOLLOWERSEXTENSION)
+
+    def recordedLease(self):
+        "the lease, as recorded by the current leader. Else my own."
+        try:
+            return float(parseHolder(readFile(self.leaseFilename()))["lease"])
+        except (KeyError, ValueError):
+            return self.lease
+
+    def recordedLastRun(self):
+        "when the periodic job last ran, as recorded by a leader. Else None."
+        try:
+            return float(parseHolder(readFile(self.leaseFilename()))["lastrun"])
+        except (KeyError, ValueError):
+            return None
+
+    def recordLease(self):
+        "As leader: my lease, and the last run of the job, for the followers."
+        record = "pid=%d lease=%g" % (os.getpid(), self.lease)
+        if self.lastRun is not None:
+            record += " lastrun=%.6f" % self.lastRun
+        writeFileAtomically(self.leaseFilename(), record)
+
+    def renew(self):
+        """Heartbeat: touch the lockdir. Only while my lease is surely not
+           expired yet, else it might belong to someone else already."""
+        now = time.time()
+        if now - self.renewedAt >= self.lease * (1 - RENEWFRACTION / 2):
+            return False
+        if not touchPath(self.L.dirname()):
+            return False
+        self.renewedAt = self.L.lockingTime = now
+        return True
+
+    def demoted(self):
+        self.isLeader = False
+        self.renewedAt = None
+        if self.on_demoted:
+            self.on_demoted(self)
+
+    def waitTime(self):
+        "seconds until the next campaign() is needed"
+        if self.isLeader:
+            return max(0, self.renewedAt + self.lease * RENEWFRACTION - time.time())
+        age = self.L.age()
+        if age == ERROR:
+            return 0 # no leader
+        return max(0, self.recordedLease() - age) + random.uniform(0, JITTER)
+
+    def sleep(self, secs):
+        "Leaders just sleep. Followers can be woken up by a resigning leader."
+        if self.isLeader:
+            time.sleep(secs)
+            return
+        doorbell = doorbellInstall(self.followersDirname())
+        try:
+            if self.L.exists(): # else it was resigned just now
+                doorbellWait(doorbell, secs)
+        finally:
+            doorbellRemove(doorbell)
+
+
+def testDLeader(workers = 3, secs = 3):
+    """Several workers, one periodic job. Only the leader runs it; the
+       followers wake up only once per lease. Then the leader resigns."""
+
+    import threading
+    jobs, events = [], []
+
+    def worker(i, duration):
+        D = DLeader("leaderExample", lease = 1,
+                    on_elected = lambda D: events.append("%d elected" % i),
+                    on_demoted = lambda D: events.append("%d demoted" % i))
+        D.run(lambda: jobs.append(i), period = 0.1, duration = duration)
+        events.append("%d woke up %d times as follower" % (i, D.wakeups))
+
+    t = [threading.Thread(target = worker, args = (i, secs + i)) for i in range(workers)]
+    for thr in t:
+        thr.start()
+        time.sleep(0.1)
+    for thr in t: thr.join()
+
+    print "%d jobs run, by workers %s." % (len(jobs), sorted(set(jobs)))
+    for event in events:
+        print "  ", event
+
+
+if __name__ == '__main__':
+    testDLeader()
@@ -0,0 +1,270 @@
+'''
+lockbydir_profiler.py - Which code holds a DLock longest, and which waits longest.
+
+@requires: lockbydir.py         # the DLock class, and defaults
+@requires: lockbydir_OS.py      # lockdir OS-level routines
+
+@call:     lockbydir_profiler.enable( sample = 0.1 )   # then use DLocks as always
+@call:     python -m lockbydir profile [--root DIR] [--top N]
+@return:   report: per lock, the top N call sites by hold time, and by wait time
+
+@summary
+
+We know some lock is hot, but not which code holds it longest.
+
+When enabled, a DLock remembers where it was acquired: the call site, i.e.
+file:line and function of the first caller outside the lockbydir modules
+(or a short stack, see DEPTH). The time it waited is attributed to that call
+site, and at unlocking the time it held the lock. If it unlocked too late
+(after TIMEOUT), that counts as a timeout of that call site. Waiters which
+gave up (PATIENCE) are counted too.
+
+Sampling: Only a fraction SAMPLE of the acquisitions is recorded. All others
+cost one random number. The recorded ones cost a walk up a few stack frames
+and a dict update. So the overhead is bounded, also for very hot locks.
+
+Across processes: Each process writes its numbers every FLUSHEVERYXSECONDS
+(checked after an unlocking, never while holding), and at exit, into its own
+pickle file in lockbydir.profile/ in the lock root of the profiled DLocks.
+report() adds up all of them.
+
+Counts in the report are sampled counts; times are real seconds.
+'''
+
+# fraction of acquisitions which are recorded:
+SAMPLE = 0.1
+
+# how many stack frames make a call site (1 = just the caller):
+DEPTH = 1
+
+# each process writes its numbers this often (and at exit):
+FLUSHEVERYXSECONDS = 5
+
+# how many call sites per lock the report shows:
+TOP = 5
+
+# dir in the lock root, with 1 pickle file per process:
+PROFILEDIRNAME = "lockbydir.profile"
+
+import os, sys, time, random, threading, platform, atexit
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+import lockbydir
+from lockbydir_OS import defaultLockRoot, listdir_OrEmpty, readFile, writeFileAtomically
+from lockbydir_OS import mkdir_ReturnWhetherSuccessful, remove_ReturnWhetherSuccessfullyRemoved
+
+# what is recorded per (lock, call site): kind -> [count, total secs, max secs]
+WAITS, HOLDS, TIMEOUTS, GIVEUPS = "waits", "holds", "timeouts", "giveups"
+KINDS = (WAITS, HOLDS, TIMEOUTS, GIVEUPS)
+
+
+class Profiler:
+    """Collects wait and hold times of DLocks, per call site. Sampled.
+       Called by DLock, if set as its PROFILER. Or for all: enable()"""
+
+    def __init__(self, sample = SAMPLE, depth = DEPTH, root = None):
+        self.sample = sample
+        self.depth = depth
+        self.root = root
+        self.FLUSHEVERYXSECONDS = FLUSHEVERYXSECONDS
+        self.stats = {}  # lock root -> {(lockname, call site) -> {kind: [count, total, max]}}
+        self.guard = threading.Lock()
+        self.pid = os.getpid()
+        self.lastFlush = time.time()
+
+    # called by DLock:
+
+    def acquired(self, L, waited):
+        "L was acquired, after waiting 'waited' seconds. Maybe sampled."
+        if random.random() >= self.sample:
+            return
+        L.profileSite = callSite(self.depth)
+        self.add(L, L.profileSite, WAITS, waited)
+
+    def released(self, L, held, timedOut = False):
+        """L was unlocked after 'held' seconds. Counted only if sampled.
+           Called after the lockdir is removed, so flushing is not measured."""
+        site = L.__dict__.pop("profileSite", None)
+        if site is None:
+            return
+        self.add(L, site, TIMEOUTS if timedOut else HOLDS, held)
+        if time.time() - self.lastFlush > self.FLUSHEVERYXSECONDS:
+            self.flush()
+
+    def gaveUp(self, L, waited):
+        "L was not acquired, patience gone after 'waited' seconds. Maybe sampled."
+        if random.random() >= self.sample:
+            return
+        self.add(L, callSite(self.depth), GIVEUPS, waited)
+
+    # end PUBLIC functions.
+    # begin PRIVATE functions. Usually no need to call them:
+
+    def add(self, L, site, kind, secs):
+        root = L.lockRoot() if self.root is None else self.root
+        with self.guard:
+            if os.getpid() != self.pid: # forked: the parent reports its own
+                self.stats, self.pid = {}, os.getpid()
+            counters = self.stats.setdefault(root, {}).setdefault((L.name, site), {})
+            n, total, most = counters.get(kind, (0, 0.0, 0.0))
+            counters[kind] = [n + 1, total + secs, max(most, secs)]
+
+    def profileDirname(self, root = None):
+        "in 'root', else in my root, else in the lock root as DLock finds it"
+        if root is None:
+            root = self.root
+        if root is None:
+            root = lockbydir.LOCKROOT
+        if root is None:
+            root = defaultLockRoot()
+        return os.path.join(root, PROFILEDIRNAME)
+
+    def filename(self, root = None):
+        return os.path.join(self.profileDirname(root),
+                            "%s-%d.pickle" % (platform.node(), os.getpid()))
+
+    def flush(self):
+        "Write my numbers (so far) to my file in the profile dir, per lock root."
+        with self.guard:
+            if os.getpid() != self.pid:
+                self.stats, self.pid = {}, os.getpid()
+            data = [(root, pickle.dumps(stats, pickle.HIGHEST_PROTOCOL))
+                    for root, stats in self.stats.items()]
+            self.lastFlush = time.time()
+        for root, pickled in data:
+            try:
+                mkdir_ReturnWhetherSuccessful(self.profileDirname(root))
+                writeFileAtomically(self.filename(root), pickled)
+            except (IOError, OSError):
+                pass # only for information, never let it break the locking
+
+
+def callSite(depth = DEPTH):
+    """'file:line function' of the first caller outside the lockbydir
+       modules. With depth > 1, also of its callers, joined by ' < '."""
+    frame, sites = sys._getframe(2), [] # above the Profiler method
+    while frame is not None and len(sites) < depth:
+        if sites or not frame.f_globals.get("__name__", "").startswith("lockbydir"):
+            code = frame.f_code
+            sites.append("%s:%d %s" % (os.path.basename(code.co_filename),
+                                       frame.f_lineno, code.co_name))
+        frame = frame.f_back
+    return " < ".join(sites) or "?"
+
+
+def enable(sample = SAMPLE, depth = DEPTH, root = None):
+    """Profile all DLocks created from now on. Their numbers are written
+       at exit at the latest. Returns the Profiler."""
+    P = Profiler(sample, depth, root)
+    lockbydir.PROFILER = P
+    atexit.register(P.flush)
+    return P
+
+def disable():
+    "DLocks created from now on are not profiled."
+    lockbydir.PROFILER = None
+
+
+def load(root = None):
+    "All processes' numbers, added up: (lockname, call site) -> {kind: [count, total, max]}"
+    profileDir = Profiler(root = root).profileDirname()
+    merged = {}
+    for filename in listdir_OrEmpty(profileDir):
+        try:
+            stats = pickle.loads(readFile(os.path.join(profileDir, filename)))
+        except Exception:
+            continue # being written, or not ours
+        for key, counters in stats.items():
+            mergedCounters = merged.setdefault(key, {})
+            for kind, (n, total, most) in counters.items():
+                n0, total0, most0 = mergedCounters.get(kind, (0, 0.0, 0.0))
+                mergedCounters[kind] = [n0 + n, total0 + total, max(most0, most)]
+    return merged
+
+def reset(root = None):
+    "Remove all processes' numbers."
+    profileDir = Profiler(root = root).profileDirname()
+    for filename in listdir_OrEmpty(profileDir):
+        remove_ReturnWhetherSuccessfullyRemoved(os.path.join(profileDir, filename))
+
+def report(root = None, top = TOP):
+    """Per lock: the 'top' call sites by total hold time (the worst holders),
+       and by total wait time (the worst waiters). As list of lines."""
+    merged = load(root)
+    byLock = {}
+    for (lockname, site), counters in merged.items():
+        byLock.setdefault(lockname, []).append( (site, counters) )
+
+    def total(counters, *kinds):
+        return sum(counters.get(kind, (0, 0, 0))[1] for kind in kinds)
+
+    def formatted(counters, kind):
+        n, secs, most = counters.get(kind, (0, 0.0, 0.0))
+        mean = secs / n if n else 0
+        return "%6d %9.4f %9.4f %9.4f" % (n, secs, mean, most)
+
+    lines = []
+    for lockname in sorted(byLock, key = lambda name: -max(
+                           total(c, HOLDS, TIMEOUTS) for _, c in byLock[name])):
+        sites = byLock[lockname]
+        lines.append("")
+        lines.append("LOCK %s" % lockname)
+        lines.append("  %-6s %6s %9s %9s %9s %8s  %s" % ("HOLD", "N", "TOTAL",
+                     "MEAN", "MAX", "TIMEOUTS", "CALL SITE"))
+        for site, counters in sorted(sites, key = lambda s: -total(s[1], HOLDS, TIMEOUTS))[:top]:
+            if HOLDS in counters or TIMEOUTS in counters:
+                lines.append("  %-6s %s %8d  %s" % ("", formatted(counters, HOLDS),
+                             counters.get(TIMEOUTS, (0,))[0], site))
+        lines.append("  %-6s %6s %9s %9s %9s %8s  %s" % ("WAIT", "N", "TOTAL",
+                     "MEAN", "MAX", "GAVEUP", "CALL SITE"))
+        for site, counters in sorted(sites, key = lambda s: -total(s[1], WAITS, GIVEUPS))[:top]:
+            if WAITS in counters or GIVEUPS in counters:
+                lines.append("  %-6s %s %8d  %s" % ("", formatted(counters, WAITS),
+                             counters.get(GIVEUPS, (0,))[0], site))
+    if not lines:
+        lines.append("(no profile yet. See lockbydir_profiler.enable)")
+    return lines
+
+
+def testProfiler(threads = 4, rounds = 40, sample = 0.5):
+    """Threads from two call sites share one lock. One holds it long.
+       The report must blame that one."""
+
+    reset()
+    P = enable(sample = sample)
+
+    def shortHold():
+        L = lockbydir.DLock("profilerExample")
+        L.CHECKEVERYXSECONDS = 0.001
+        if L.LoopWhileLocked_ThenLocking():
+            time.sleep(0.001)
+            L.unlocking()
+
+    def longHold():
+        L = lockbydir.DLock("profilerExample")
+        L.CHECKEVERYXSECONDS = 0.001
+        if L.LoopWhileLocked_ThenLocking():
+            time.sleep(0.01)
+            L.unlocking()
+
+    def worker(i):
+        for _ in range(rounds):
+            (longHold if i == 0 else shortHold)()
+
+    t = [threading.Thread(target = worker, args = (i,)) for i in range(threads)]
+    for thr in t: thr.start()
+    for thr in t: thr.join()
+    P.flush()
+    disable()
+
+    print "sample = %g:" % sample,
+    for line in report(top = 3):
+        print line
+
+
+if __name__ == '__main__':
+    testProfiler()
@@ -0,0 +1,253 @@
+'''
+lockbydir_queue.py - Cross-process work queue, jobs are claimed by mkdir.
+
+@requires: lockbydir.py         # the DLock class, and defaults
+@requires: lockbydir_OS.py      # lockdir OS-level routines
+
+@call:     Q = ClaimQueue( "jobs" ); Q.enqueue( job ); Q.claim( 10 ); Q.ack( id )
+@return:   class with .enqueue() .claimNext() .claim(k) .ack() .release() .renew()
+
+@summary
+
+Instead of one DLock per job file, which every worker re-scans and tries to
+lock, a ClaimQueue keeps its jobs in 4 subdirs of its root:
+
+    tmp/        jobs being written (then renamed into ready/, so atomic)
+    ready/      unclaimed jobs. This dir IS the index: nothing else in there.
+    inflight/   claimed jobs, until acked
+    claims/     one lockdir per claimed job. The same atomic mkdir as DLock.
+
+Claiming a job = mkdir of its claim lockdir (only one worker can succeed),
+then rename of the job from ready/ to inflight/<id>.<claimtoken>. The age of 
+the claim lockdir is the lease: After LEASE seconds without ack (or renew), 
+the claim expired, and the job is moved back to ready/ by the next 
+reclaimExpired(). So each job runs at least once. A late ack of an expired
+claim fails, because its claimtoken is gone.
+
+Each worker lists ready/ only when its local copy of that listing is used up,
+so a claim is usually 1 mkdir + 1 rename, not a directory scan. Each worker
+walks its copy from a random place on (and wraps around), so concurrent
+workers do not all race for the same oldest jobs. Oldest first is therefore
+only per worker, and roughly.
+'''
+
+# seconds after which an un-acked claim expires, and the job is handed out again:
+from lockbydir import TIMEOUT as LEASE
+
+# how often (seconds) a worker looks for expired claims:
+RECLAIMEVERYXSECONDS = 1
+
+import os, time, random, collections
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+import lockbydir
+from lockbydir import DLock
+from lockbydir_OS import LOCKDIREXTENSION, pathAgeInSeconds, touchPath, defaultLockRoot
+from lockbydir_OS import mkdir_ReturnWhetherSuccessful, rmdir_ReturnWhetherSuccessfullyRemoved
+from lockbydir_OS import readFile, remove_ReturnWhetherSuccessfullyRemoved
+
+
+class ClaimQueue:
+    """Jobs (any picklable object) in a directory 'root'.
+       A relative 'root' is placed into the DLock lock root
+       (lockbydir.LOCKROOT, else the default one)."""
+
+    def __init__(self, root):
+        lockRoot = lockbydir.LOCKROOT
+        if lockRoot is None:
+            lockRoot = defaultLockRoot()
+        self.root = os.path.join(lockRoot, root)
+        self.LEASE = LEASE
+        self.RECLAIMEVERYXSECONDS = RECLAIMEVERYXSECONDS
+
+        self.index = collections.deque() # my copy of the ready/ listing
+        self.lastReclaim = 0
+        self.counter = 0
+        self.collisions = 0 # claims which someone else was faster for
+
+        for sub in ("tmp", "ready", "inflight", "claims"):
+            path = os.path.join(self.root, sub)
+            if not os.path.isdir(path):
+                try: os.makedirs(path)
+                except OSError: pass # concurrently created by someone else
+
+    def enqueue(self, job):
+        "Add a job. Returns its id. Ids sort in order of enqueueing."
+        self.counter += 1
+        jobid = "%.6f-%d-%d-%04x" % (time.time(), os.getpid(), self.counter,
+                                     random.getrandbits(16))
+        tmpname = self.path("tmp", jobid)
+        with open(tmpname, "wb") as f:
+            pickle.dump(job, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmpname, self.path("ready", jobid))
+        return jobid
+
+    def claimNext(self):
+        "Claim one job. Returns (handle, job), or None if there is none."
+        claimed = self.claim(1)
+        return claimed[0] if claimed else None
+
+    def claim(self, k):
+        """Claim up to k jobs, roughly oldest first. Returns list of (handle, job).
+           The handle is needed for ack, release, and renew."""
+        if time.time() - self.lastReclaim > self.RECLAIMEVERYXSECONDS:
+            self.reclaimExpired()
+
+        claimed, refreshed = [], False
+        while len(claimed) < k:
+            if not self.index:
+                if refreshed:
+                    break # ready/ is empty
+                self.refreshIndex()
+                refreshed = True
+                continue
+            jobid = self.index.popleft()
+            handle = self.claimOne(jobid)
+            if handle is not None:
+                job = pickle.loads(readFile(self.path("inflight", handle)))
+                claimed.append( (handle, job) )
+        return claimed
+
+    def ack(self, handle):
+        """Job is done, remove it.
+           Returns False if the claim had expired, and was reclaimed."""
+        if not remove_ReturnWhetherSuccessfullyRemoved(self.path("inflight", handle)):
+            return False
+        rmdir_ReturnWhetherSuccessfullyRemoved(self.claimDirname(jobOf(handle)))
+        return True
+
+    def release(self, handle):
+        "Give a claimed job back, unfinished. Returns False if it was reclaimed."
+        try:
+            os.rename(self.path("inflight", handle), self.path("ready", jobOf(handle)))
+        except OSError:
+            return False
+        rmdir_ReturnWhetherSuccessfullyRemoved(self.claimDirname(jobOf(handle)))
+        return True
+
+    def renew(self, handle):
+        "Extend the lease of a claimed job by another LEASE seconds."
+        if not os.path.exists(self.path("inflight", handle)):
+            return False # expired and reclaimed
+        return touchPath(self.claimDirname(jobOf(handle)))
+
+    def pending(self):
+        "number of unclaimed jobs. N.B.: A directory scan."
+        return len(os.listdir(os.path.join(self.root, "ready")))
+
+    # end PUBLIC functions.
+    # begin PRIVATE functions. Usually no need to call them:
+
+    def path(self, sub, jobid):
+        return os.path.join(self.root, sub, jobid)
+
+    def claimDirname(self, jobid):
+        return os.path.join(self.root, "claims", jobid + LOCKDIREXTENSION)
+
+    def refreshIndex(self):
+        "one scan of ready/, oldest first, but starting at a random place"
+        self.index = collections.deque(sorted(os.listdir(os.path.join(self.root, "ready"))))
+        if self.index:
+            self.index.rotate(-random.randrange(len(self.index)))
+
+    def claimOne(self, jobid):
+        """mkdir claim, then move job to inflight/.
+           Returns the handle, or None if someone else was faster."""
+        claim = self.claimDirname(jobid)
+        if not mkdir_ReturnWhetherSuccessful(claim):
+            self.collisions += 1
+            return None # claimed by someone else
+        handle = "%s.%d-%06x" % (jobid, os.getpid(), random.getrandbits(24))
+        try:
+            os.rename(self.path("ready", jobid), self.path("inflight", handle))
+        except OSError:
+            rmdir_ReturnWhetherSuccessfullyRemoved(claim)
+            return None # was already done, my index is old
+        return handle
+
+    def reclaimExpired(self):
+        """Move jobs with claims older than LEASE back to ready/.
+           Only one worker at a time does this; others skip it."""
+        self.lastReclaim = time.time()
+        G = DLock("reclaim")
+        G.LOCKROOT = self.root
+        if G.isLocked() or not G.locking(): # isLocked removes a timed-out one
+            return 0
+        reclaimed = 0
+        try:
+            expired = []
+            for entry in os.listdir(os.path.join(self.root, "claims")):
+                claim = os.path.join(self.root, "claims", entry)
+                if pathAgeInSeconds(claim) > self.LEASE:
+                    expired.append( (entry[:-len(LOCKDIREXTENSION)], claim) )
+            if expired:
+                handles = os.listdir(os.path.join(self.root, "inflight"))
+            for jobid, claim in expired:
+                for handle in handles:
+                    if jobOf(handle) != jobid:
+                        continue
+                    try:
+                        os.rename(self.path("inflight", handle), self.path("ready", jobid))
+                        reclaimed += 1
+                    except OSError:
+                        pass # acked meanwhile
+                rmdir_ReturnWhetherSuccessfullyRemoved(claim)
+        finally:
+            G.unlocking()
+        return reclaimed
+
+
+def jobOf(handle):
+    "the job id of a claim handle"
+    return handle.rpartition(".")[0]
+
+
+def testClaimQueue(jobs = 3000, workers = 8, k = 10):
+    "Workers claim batches of k, and ack. Each job should be done exactly once."
+
+    import threading, shutil
+    Q = ClaimQueue("queueExample")
+    shutil.rmtree(Q.root)
+    Q = ClaimQueue("queueExample")
+
+    for i in range(jobs):
+        Q.enqueue(i)
+    done, collisions = [], []
+
+    def worker():
+        W = ClaimQueue("queueExample") # each worker has its own index
+        while True:
+            batch = W.claim(k)
+            if not batch:
+                break
+            for handle, job in batch:
+                done.append(job)
+                W.ack(handle)
+        collisions.append(W.collisions)
+
+    start = time.time()
+    t = [threading.Thread(target = worker) for _ in range(workers)]
+    for thr in t: thr.start()
+    for thr in t: thr.join()
+    secs = time.time() - start
+
+    print "%d jobs, %d workers: %d done, %d distinct, %d pending." % (
+           jobs, workers, len(done), len(set(done)), Q.pending()),
+    print "%.0f jobs/second, %d claim collisions" % (len(done) / secs, sum(collisions))
+
+    print "Expired claim is handed out again:",
+    Q.LEASE = 0.1
+    Q.enqueue("forgotten")
+    handle, job = Q.claimNext()
+    time.sleep(0.2)
+    Q.lastReclaim = 0
+    print Q.claimNext()[1] == job, "and late ack =", Q.ack(handle)
+    shutil.rmtree(Q.root)
+
+
+if __name__ == '__main__':
+    testClaimQueue()
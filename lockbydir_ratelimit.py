@@ -0,0 +1,138 @@
+'''
+lockbydir_ratelimit.py - Cross-process rate limiter (token bucket), for shared downstreams.
+
+@requires: lockbydir.py         # the DLock class
+@requires: lockbydir_OS.py      # lockdir OS-level routines
+
+@call:     R = DRateLimiter( "name", rate = 100, burst = 10 );  R.acquire()
+@return:   True when allowed to go on, False if PATIENCE would be exceeded
+
+@summary
+
+Throttling calls to a shared downstream with a DLock serializes the callers
+far more than needed. A DRateLimiter lets through 'rate' calls per second,
+across all processes, with bursts of up to 'burst' calls.
+
+The bucket state is one number in a small file next to the lockdir,
+<name>.bucket: the 'theoretical arrival time' (TAT) of the next call, as in
+the generic cell rate algorithm (GCRA). It is read and updated under a brief
+DLock, no longer than a few file operations.
+
+A caller reserves its slot in time, releases the DLock, and then sleeps until
+exactly that slot. No polling. So the callers together fill the allowed rate
+exactly, neither more nor less. If the slot is later than the caller's
+patience allows, nothing is reserved, and acquire() returns False at once.
+'''
+
+# default patience, seconds:
+from lockbydir import PATIENCE
+
+# the DLock around the bucket state is held only very briefly:
+BUCKETTIMEOUT = 1
+BUCKETCHECKEVERYXSECONDS = 0.001
+
+# bucket state file extension:
+BUCKETEXTENSION = ".bucket"
+
+import os, time
+
+from lockbydir import DLock
+from lockbydir_OS import writeFileAtomically, readFile
+
+
+class DRateLimiter:
+    """'rate' tokens per second, 'burst' tokens at once.
+       All instances with the same 'name' share one bucket."""
+
+    def __init__(self, name, rate, burst = 1):
+        self.name = name
+        self.rate = float(rate)
+        self.burst = burst
+        self.PATIENCE = PATIENCE
+        self.L = DLock(name)
+        self.L.TIMEOUT = BUCKETTIMEOUT
+        self.L.CHECKEVERYXSECONDS = BUCKETCHECKEVERYXSECONDS
+
+    def acquire(self, tokens = 1, patience = None):
+        """Take 'tokens' from the bucket. Sleeps until they are available.
+           Returns True then. Returns False at once (without taking anything)
+           if that would take longer than 'patience' (default PATIENCE)."""
+        if patience is None:
+            patience = self.PATIENCE
+        start = time.time()
+
+        wait = self.reserve(tokens, start + patience)
+        if wait is None:
+            return False
+        if wait > 0:
+            time.sleep(wait)
+        return True
+
+    def tryAcquire(self, tokens = 1):
+        "Take 'tokens' only if available right now. Returns whether taken."
+        return self.acquire(tokens, 0)
+
+    # end PUBLIC functions.
+    # begin PRIVATE functions. Usually no need to call them:
+
+    def filename(self):
+        "the bucket state file, next to the lockdir"
+        return os.path.join(self.L.lockRoot(), self.name + BUCKETEXTENSION)
+
+    def reserve(self, tokens, deadline):
+        """Under the DLock: Reserve the next slot for 'tokens', if it is
+           before 'deadline'. Returns seconds to wait until then, or None."""
+        L = self.L
+        L.PATIENCE = max(0, deadline - time.time())
+        if not (L.locking() or L.LoopWhileLocked_ThenLocking()):
+            return None
+        try:
+            now = time.time()
+            interval = 1 / self.rate
+            try:
+                tat = float(readFile(self.filename()))
+            except (TypeError, ValueError):
+                tat = now # no bucket yet, or damaged: a full bucket
+
+            newTat = max(tat, now) + tokens * interval
+            allowedAt = newTat - self.burst * interval
+            if allowedAt > deadline:
+                return None
+            writeFileAtomically(self.filename(), "%.6f" % newTat)
+            return max(0, allowedAt - now)
+        finally:
+            L.unlocking()
+
+
+def testDRateLimiter(threads = 4, calls = 50, rate = 100, burst = 5):
+    "Several threads call as fast as allowed. Together they should get 'rate'."
+
+    import threading
+    name = "rateLimiterExample"
+    R = DRateLimiter(name, rate, burst)
+    if os.path.exists(R.filename()):
+        os.remove(R.filename())
+    times = []
+
+    def caller():
+        R = DRateLimiter(name, rate, burst)
+        for _ in range(calls):
+            if R.acquire():
+                times.append(time.time())
+
+    start = time.time()
+    t = [threading.Thread(target = caller) for _ in range(threads)]
+    for thr in t: thr.start()
+    for thr in t: thr.join()
+    times.sort()
+
+    print "%d calls at rate=%d, burst=%d:" % (len(times), rate, burst),
+    print "%.1f calls/second" % ((len(times) - burst) / (times[-1] - start)),
+    print "(after the first burst)."
+    print "tryAcquire now (bucket empty):", R.tryAcquire(),
+    time.sleep(burst / float(rate))
+    print "- after refill:", R.tryAcquire()
+
+
+if __name__ == '__main__':
+    testDRateLimiter()
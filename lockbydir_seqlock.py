@@ -0,0 +1,182 @@
+'''
+lockbydir_seqlock.py - Sequence lock: lock-free readers for read-mostly files.
+
+@requires: lockbydir.py         # the DLock class, and defaults
+@requires: lockbydir_OS.py      # lockdir OS-level routines
+
+@call:     S = SeqLock( "name" );  S.write( writefn );  S.read( readfn )
+@return:   class with .write() .read(), and .beginWrite() .endWrite()
+
+@summary
+
+For config and cache files which are read thousands of times per second, and
+written rarely. Even a shared lock costs each reader filesystem operations.
+
+Writers hold the normal (exclusive) DLock, and increment a version counter
+before and after writing. So while a write is going on, the version is odd.
+The counter is a small file next to the lockdir, <name>.seq, mmap'ed:
+reading it costs no system call at all.
+
+Readers take no lock: They read the version, read the data, read the version
+again. If it was odd, or has changed, they retry. So readers never block a
+writer, never block each other, and scale with the number of cores.
+
+If a writer dies during a write, the version stays odd until the next writer
+(after the lock's TIMEOUT), so readers retry until then, or until PATIENCE.
+'''
+
+# default patience of readers, seconds:
+from lockbydir import PATIENCE
+
+# readers retry after this many seconds, while a write is going on:
+RETRYSLEEP = 0.0005
+
+# version counter file extension:
+SEQEXTENSION = ".seq"
+
+import os, time, mmap, struct
+
+from lockbydir import DLock
+
+VERSIONFORMAT = "<Q" # 8 bytes, unsigned
+VERSIONSIZE = struct.calcsize(VERSIONFORMAT)
+
+
+class SeqLock:
+    """Writers: DLock, plus version counter. Readers: no lock, retry.
+       Lock parameters of writers are those of self.L (a DLock)."""
+
+    def __init__(self, name):
+        self.name = name
+        self.L = DLock(name)
+        self.PATIENCE = PATIENCE
+        self.RETRYSLEEP = RETRYSLEEP
+        self.counter = None  # the mmap, opened when first needed
+        self.retries = 0     # how often my reads had to be repeated
+
+    def read(self, readfn, patience = None):
+        """Call readfn() until it ran without a write going on.
+
+           Returns (True, readfn's result).
+           Returns (False, None) if 'patience' seconds (default PATIENCE)
+           went by without a consistent read."""
+        if patience is None:
+            patience = self.PATIENCE
+        deadline = None
+
+        while True:
+            before = self.version()
+            if not before & 1:
+                try:
+                    value = readfn()
+                except Exception:
+                    if self.version() == before:
+                        raise # a real error, not a torn read
+                else:
+                    if self.version() == before:
+                        return True, value
+
+            self.retries += 1
+            if deadline is None:
+                deadline = time.time() + patience
+            elif time.time() > deadline:
+                return False, None
+            time.sleep(self.RETRYSLEEP)
+
+    def write(self, writefn):
+        """Lock, call writefn(), unlock. Returns (True, writefn's result),
+           or (False, None) if the lock was not acquired within PATIENCE."""
+        if not self.beginWrite():
+            return False, None
+        try:
+            return True, writefn()
+        finally:
+            self.endWrite()
+
+    def beginWrite(self):
+        "Acquire the DLock, make the version odd. False if not acquired."
+        if not self.L.LoopWhileLocked_ThenLocking():
+            return False
+        version = self.version()
+        self.setVersion(version + (1 if version % 2 == 0 else 2)) # odd
+        return True
+
+    def endWrite(self):
+        "Make the version even, unlock the DLock. Returns result of unlocking."
+        version = self.version()
+        self.setVersion(version + (1 if version % 2 == 1 else 2)) # even
+        return self.L.unlocking()
+
+    # end PUBLIC functions.
+    # begin PRIVATE functions. Usually no need to call them:
+
+    def filename(self):
+        "the version counter file, next to the lockdir"
+        return os.path.join(self.L.lockRoot(), self.name + SEQEXTENSION)
+
+    def openCounter(self):
+        "mmap the version counter file. Created (as version 0) if needed."
+        fd = os.open(self.filename(), os.O_RDWR | os.O_CREAT)
+        try:
+            if os.fstat(fd).st_size < VERSIONSIZE:
+                os.ftruncate(fd, VERSIONSIZE) # zeros; harmless if concurrent
+            self.counter = mmap.mmap(fd, VERSIONSIZE)
+        finally:
+            os.close(fd) # the mmap stays valid
+
+    def version(self):
+        if self.counter is None:
+            self.openCounter()
+        return struct.unpack(VERSIONFORMAT, self.counter[:VERSIONSIZE])[0]
+
+    def setVersion(self, version):
+        self.counter[:VERSIONSIZE] = struct.pack(VERSIONFORMAT, version)
+
+
+def testSeqLock(readers = 4, secs = 1):
+    """A writer rewrites a file (in place, slowly), readers must never see
+       a mix of old and new content. Shows reads per second."""
+
+    import threading, tempfile
+    filename = os.path.join(tempfile.gettempdir(), "seqlockExample.txt")
+    with open(filename, "w") as f:
+        f.write("a" * 1000)
+    stop, reads, torn = [], [], []
+
+    def writer():
+        S = SeqLock("seqlockExample")
+        for letter in "bcdefghij" * 100:
+            if stop: break
+            def rewrite():
+                with open(filename, "r+") as f:
+                    f.write(letter * 500)
+                    f.flush()
+                    time.sleep(0.001) # half written now
+                    f.write(letter * 500)
+            S.write(rewrite)
+            time.sleep(0.01)
+
+    def reader():
+        S = SeqLock("seqlockExample")
+        n = 0
+        while not stop:
+            ok, content = S.read(lambda: open(filename).read())
+            if ok and len(set(content)) != 1:
+                torn.append(content)
+            n += 1
+        reads.append( (n, S.retries) )
+
+    t = [threading.Thread(target = writer)]
+    t += [threading.Thread(target = reader) for _ in range(readers)]
+    for thr in t: thr.start()
+    time.sleep(secs)
+    stop.append(True)
+    for thr in t: thr.join()
+
+    print "%d readers: %d consistent reads/second, %d retries, %d torn reads." % (
+           readers, sum(n for n, _ in reads) / secs, sum(r for _, r in reads), len(torn))
+    os.remove(filename)
+
+
+if __name__ == '__main__':
+    testSeqLock()
@@ -0,0 +1,399 @@
+'''
+lockbydir_simulator.py - Discrete-event simulator, for tuning TIMEOUT, PATIENCE, CHECKEVERYXSECONDS.
+
+@requires: lockbydir.py         # defaults
+@requires: lockbydir_OS.py      # ERROR, for measureCosts()
+
+@call:     result = Simulator( arrivalRate = 20, hold = LogNormal(0.02, 1) ).run()
+@call:     results = sweep( {"CHECKEVERYXSECONDS": [0.001, 0.03], "PATIENCE": [1, 5]}, ... )
+@return:   dict with throughput, wait percentiles, giveupRate, fsopsPerSecond, ...
+
+@summary
+
+Instead of running lockbydir_concurrent variants and eyeballing the output:
+Describe the workload once, and let the simulator predict for each parameter
+set what would happen. Seconds instead of trials in production.
+
+Workload:
+* arrivalRate: clients per second which want the lock (Poisson arrivals)
+* hold: distribution of the hold times, e.g. Empirical(measured seconds)
+* forget: fraction of holders which never unlock (crash), so TIMEOUT matters
+* costs: seconds per filesystem call, e.g. measureCosts() on your machine
+
+Model: Each client is a generator, which makes exactly the calls which
+DLock.LoopWhileLocked_ThenLocking() and .unlocking() make: the check for
+higher priority waiters (exists, listdir), then mkdir first, then
+exists, getmtime, rmdir of a timed-out lockdir (twice getmtime, as the code
+does), polling every CHECKEVERYXSECONDS until unlocked or PATIENCE is gone
+(isLocked twice before the first sleep, as loopWhileLocked does).
+Each call happens at one moment, and costs its time. An event queue (heapq)
+in virtual time runs all clients. The lock is one 'exists' flag, plus mtime.
+(If DLock's acquire path changes, change client() the same way. Real code
+in virtual time, but slower: lockbydir_harness.py)
+
+Every client which has to loop registers in the waiting dir (2 mkdir), and
+unregisters at the end (2 rmdir), as in DLock. With MAXWAITERS, a client
+which would be waiter number MAXWAITERS + 1 is rejected at once (admission
+control), as in DLock.
+
+Results: throughput (acquisitions per second), percentiles of the waiting
+time (of those who acquired), give-up rate (PATIENCE gone), reject rate 
+(MAXWAITERS), filesystem calls
+per second, timed-out holds (held longer than TIMEOUT: unprotected!), and
+overlaps (a second holder while the first was still working).
+
+sweep(): every combination of the given parameter values, all with the same
+random numbers, so that differences come from the parameters only. In
+several processes, if asked to.
+'''
+
+# seconds per filesystem call, on a RAM disk. Better: measureCosts()
+COSTS = {"mkdir": 0.000004, "rmdir": 0.000004, "exists": 0.000002,
+         "getmtime": 0.000003, "listdir": 0.000005, 
+         "sleep": 0.00008}  # sleep = oversleeping
+
+from lockbydir import TIMEOUT, PATIENCE, CHECKEVERYXSECONDS, REMOVETIMEDOUT, MAXWAITERS
+PARAMETERS = {"TIMEOUT": TIMEOUT, "PATIENCE": PATIENCE,
+              "CHECKEVERYXSECONDS": CHECKEVERYXSECONDS,
+              "REMOVETIMEDOUT": REMOVETIMEDOUT, "MAXWAITERS": MAXWAITERS}
+
+# simulated seconds of arrivals:
+DURATION = 60
+
+# wait time percentiles in the results:
+PERCENTILES = (50, 90, 99)
+
+import os, time, heapq, random, itertools, math
+
+from lockbydir_OS import ERROR
+
+
+## hold time distributions. Classes, not closures, so that sweep() can
+## send them to other processes.
+
+class Constant:
+    def __init__(self, secs):
+        self.secs = secs
+    def __call__(self, rng):
+        return self.secs
+
+class Exponential:
+    def __init__(self, mean):
+        self.mean = mean
+    def __call__(self, rng):
+        return rng.expovariate(1.0 / self.mean)
+
+class LogNormal:
+    "typical for hold times: mostly short, with a long tail"
+    def __init__(self, median, sigma):
+        self.median, self.sigma = median, sigma
+    def __call__(self, rng):
+        return rng.lognormvariate(math.log(self.median), self.sigma)
+
+class Empirical:
+    "measured hold times, e.g. from lockbydir_profiler, drawn at random"
+    def __init__(self, samples):
+        self.samples = list(samples)
+    def __call__(self, rng):
+        return rng.choice(self.samples)
+
+
+class Simulator:
+    """One workload, one parameter set. Call .run() once."""
+
+    def __init__(self, arrivalRate, hold, duration = DURATION, forget = 0.0,
+                 costs = None, parameters = None, seed = 1):
+        self.arrivalRate = arrivalRate
+        self.hold = hold
+        self.duration = duration
+        self.forget = forget
+        self.costs = dict(COSTS, **(costs or {}))
+        self.P = dict(PARAMETERS, **(parameters or {}))
+        self.rng = random.Random(seed)
+
+        self.now = 0.0
+        self.queue = []                     # (time, sequence, generator)
+        self.sequence = itertools.count()
+        self.lockExists, self.lockMtime = False, None
+        self.holders = 0                    # who believe to hold the lock
+        self.waiting = 0                    # registered waiters, MAXWAITERS
+
+        self.waits, self.giveups, self.rejected, self.arrivals = [], 0, 0, 0
+        self.fsops = dict((op, 0) for op in self.costs if op != "sleep")
+        self.timedOutHolds, self.overlaps = 0, 0
+
+    def run(self):
+        self.schedule(0, self.arrivals_())
+        while self.queue:
+            self.now, _, process = heapq.heappop(self.queue)
+            try:
+                delay = next(process)
+            except StopIteration:
+                continue
+            self.schedule(delay, process)
+        return self.results()
+
+    # end PUBLIC functions.
+    # begin PRIVATE functions. Usually no need to call them:
+
+    def schedule(self, delay, process):
+        heapq.heappush(self.queue, (self.now + delay, next(self.sequence), process))
+
+    def results(self):
+        waits = sorted(self.waits)
+        acquisitions = len(waits)
+        result = {"arrivals": self.arrivals, "acquisitions": acquisitions,
+                  "throughput": acquisitions / float(self.duration),
+                  "giveups": self.giveups,
+                  "giveupRate": self.giveups / float(self.arrivals or 1),
+                  "rejected": self.rejected,
+                  "rejectRate": self.rejected / float(self.arrivals or 1),
+                  "fsops": sum(self.fsops.values()),
+                  "fsopsPerSecond": sum(self.fsops.values()) / float(self.duration),
+                  "fsopsByCall": dict(self.fsops),
+                  "timedOutHolds": self.timedOutHolds, "overlaps": self.overlaps,
+                  "meanWait": sum(waits) / acquisitions if acquisitions else 0.0}
+        for p in PERCENTILES:
+            result["p%dWait" % p] = percentile(waits, p)
+        return result
+
+    # the filesystem: the lockdir, as flag and mtime. Each call is counted.
+
+    def fs(self, op):
+        self.fsops[op] += 1
+        if op == "mkdir":
+            if self.lockExists:
+                return False
+            self.lockExists, self.lockMtime = True, self.now
+            return True
+        if op == "rmdir":
+            removed, self.lockExists = self.lockExists, False
+            return removed
+        if op == "exists":
+            return self.lockExists
+        if op == "getmtime": # as pathAgeInSeconds
+            return self.now - self.lockMtime if self.lockExists else ERROR
+        if op == "listdir": # the waiting dir
+            return self.waiting
+
+    # processes: generators which yield how long they take, or sleep.
+
+    def arrivals_(self):
+        "Poisson arrivals, until 'duration'"
+        while True:
+            yield self.rng.expovariate(self.arrivalRate)
+            if self.now > self.duration:
+                return
+            self.arrivals += 1
+            self.schedule(0, self.client())
+
+    def isLocked(self, out):
+        "DLock.isLocked: exists, timedOut, maybe removeIfTimedOut. Result into 'out'."
+        exists = self.fs("exists")
+        yield self.costs["exists"]
+        if not exists:
+            out.append(False)
+            return
+        age = self.fs("getmtime")
+        yield self.costs["getmtime"]
+        if age > self.P["TIMEOUT"]:
+            if self.P["REMOVETIMEDOUT"]:
+                age = self.fs("getmtime") # again, in removeIfTimedOut
+                yield self.costs["getmtime"]
+                if age > self.P["TIMEOUT"]:
+                    self.fs("rmdir")
+                    yield self.costs["rmdir"]
+            out.append(False)
+            return
+        out.append(True)
+
+    def locking(self, out):
+        "DLock.locking: mkdir first; if that failed, and not locked, mkdir again"
+        acquired = self.fs("mkdir")
+        yield self.costs["mkdir"]
+        if not acquired:
+            locked = []
+            for delay in self.isLocked(locked):
+                yield delay
+            if not locked[0]:
+                acquired = self.fs("mkdir")
+                yield self.costs["mkdir"]
+        out.append(acquired)
+
+    def higherPriorityWaiting(self):
+        """DLock.higherPriorityWaiting: exists of the waiting dir (there while
+           anyone is registered), then listdir. All clients have the same 
+           priority (none), so never True. Only the calls are counted."""
+        self.fsops["exists"] += 1 # not of the lockdir
+        yield self.costs["exists"]
+        if self.waiting:
+            self.fsops["listdir"] += 1
+            yield self.costs["listdir"]
+
+    def client(self):
+        "One DLock.LoopWhileLocked_ThenLocking(), hold, unlocking()"
+        P, start = self.P, self.now
+        stillPatience = lambda: self.now - start < P["PATIENCE"]
+
+        for delay in self.higherPriorityWaiting():
+            yield delay
+        result = []
+        for delay in self.locking(result):
+            yield delay
+        acquired = result[0]
+        registered = False
+        if not acquired and P["MAXWAITERS"] is not None: # admission control
+            waiters = self.fs("listdir")
+            yield self.costs["listdir"]
+            if waiters >= P["MAXWAITERS"]:
+                self.rejected += 1
+                return
+        if not acquired: # every looping waiter registers
+            self.fsops["mkdir"] += 2 # waiting dir, and my marker. Not the lockdir
+            yield 2 * self.costs["mkdir"]
+            self.waiting, registered = self.waiting + 1, True
+        while not acquired and stillPatience():
+            locked = []                                 # loopWhileLocked:
+            for delay in self.isLocked(locked):
+                yield delay
+            if locked[-1]: # and the while condition asks again, before sleeping
+                for delay in self.isLocked(locked):
+                    yield delay
+            while locked[-1] and stillPatience():
+                yield P["CHECKEVERYXSECONDS"] + self.costs["sleep"]
+                for delay in self.isLocked(locked):
+                    yield delay
+            for delay in self.higherPriorityWaiting():
+                yield delay
+            result = []
+            for delay in self.locking(result):
+                yield delay
+            acquired = result[0]
+        if registered:
+            self.waiting -= 1
+            self.fsops["rmdir"] += 2 # my marker, and (if I was the last) the waiting dir
+            yield 2 * self.costs["rmdir"]
+
+        if not acquired:
+            self.giveups += 1
+            return
+        self.waits.append(self.now - start)
+        lockingTime = self.now
+        if self.holders:
+            self.overlaps += 1
+        self.holders += 1
+        yield self.hold(self.rng)
+        self.holders -= 1
+        if self.rng.random() < self.forget:
+            return # crashed, never unlocks
+        if self.now - lockingTime < P["TIMEOUT"]:
+            self.fs("rmdir")
+            yield self.costs["rmdir"]
+        else:
+            self.timedOutHolds += 1
+
+
+def percentile(ordered, p):
+    "p-th percentile of an ordered list, 0.0 if empty"
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100.0))]
+
+def simulate(args):
+    "(parameters, workload) -> (parameters, result). For sweep()"
+    parameters, workload = args
+    return parameters, Simulator(parameters = parameters, **workload).run()
+
+def sweep(grid, processes = None, **workload):
+    """Simulate every combination of the parameter values in 'grid' (dict:
+       parameter name -> list of values), with the same workload and seed.
+       In several processes, if 'processes' > 1.
+       Returns list of (parameters, result)."""
+    names = sorted(grid)
+    points = [dict(zip(names, values))
+              for values in itertools.product(*[grid[name] for name in names])]
+    jobs = [(point, workload) for point in points]
+    if processes and processes > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(processes)
+        try:
+            return pool.map(simulate, jobs)
+        finally:
+            pool.close()
+    return map(simulate, jobs)
+
+def table(results, parameterNames = None):
+    "results of sweep() as lines of a table"
+    if parameterNames is None:
+        parameterNames = sorted(results[0][0]) if results else []
+    columns = [("throughput", "%10.2f"), ("p50Wait", "%8.4f"), ("p90Wait", "%8.4f"),
+               ("p99Wait", "%8.4f"), ("giveupRate", "%7.3f"), ("rejectRate", "%7.3f"),
+               ("fsopsPerSecond", "%10.0f"), ("timedOutHolds", "%8d")]
+    header = " ".join("%12s" % name[:12] for name in parameterNames)
+    header += " %10s %8s %8s %8s %7s %7s %10s %8s" % ("ACQ/S", "P50WAIT", "P90WAIT",
+                            "P99WAIT", "GIVEUP", "REJECT", "FSOPS/S", "TIMEDOUT")
+    lines = [header]
+    for parameters, result in results:
+        line = " ".join("%12s" % parameters[name] for name in parameterNames)
+        line += " " + " ".join(fmt % result[name] for name, fmt in columns)
+        lines.append(line)
+    return lines
+
+
+def measureCosts(n = 2000, root = None):
+    """Seconds per filesystem call of the lockdir, and of oversleeping,
+       measured on this machine, in the lock root. As input for Simulator."""
+    from lockbydir import DLock
+    from lockbydir_OS import pathExists, pathAgeInSeconds
+    L = DLock("simulatorCosts")
+    if root is not None:
+        L.LOCKROOT = root
+    path = L.dirname()
+    L.breakLock()
+
+    def perCall(fn):
+        start = time.time()
+        for _ in xrange(n):
+            fn()
+        return (time.time() - start) / n
+
+    costs = {}
+    start = time.time()
+    for _ in xrange(n):
+        os.mkdir(path)
+        os.rmdir(path)
+    both = (time.time() - start) / n
+    costs["exists"] = perCall(lambda: pathExists(path))
+    os.mkdir(path)
+    costs["getmtime"] = perCall(lambda: pathAgeInSeconds(path))
+    os.rmdir(path)
+    costs["mkdir"] = costs["rmdir"] = both / 2
+    start = time.time()
+    for _ in xrange(50):
+        time.sleep(0.001)
+    costs["sleep"] = max(0, (time.time() - start) / 50 - 0.001)
+    return costs
+
+
+def testSimulator(processes = 2):
+    """A workload: 20 clients/s, hold times mostly 20ms with a long tail,
+    1 in 1000 crashes while holding. Which parameters are best?"""
+
+    costs = measureCosts()
+    print "measured costs:", ", ".join("%s %.1fus" % (op, secs * 1e6)
+                                       for op, secs in sorted(costs.items()))
+
+    grid = {"CHECKEVERYXSECONDS": [0.001, 0.01, 0.03, 0.1],
+            "PATIENCE": [1, 5], "TIMEOUT": [2, 10]}
+    start = time.time()
+    results = sweep(grid, processes = processes, arrivalRate = 20,
+                    hold = LogNormal(0.02, 1), forget = 0.001,
+                    duration = 30, costs = costs)
+    print "%d parameter sets simulated in %.1f seconds:" % (len(results),
+                                                          time.time() - start)
+    for line in table(results, ["TIMEOUT", "PATIENCE", "CHECKEVERYXSECONDS"]):
+        print line
+
+
+if __name__ == '__main__':
+    testSimulator()
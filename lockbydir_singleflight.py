@@ -0,0 +1,149 @@
+'''
+lockbydir_singleflight.py - Compute once, share the result across processes.
+
+@requires: lockbydir.py         # the DLock class
+@requires: lockbydir_OS.py      # lockdir OS-level routines
+
+@call:     value = single_flight( "name", fn )
+@return:   the result of fn(), computed by this or by another process
+
+@summary
+
+Typical DLock usage: Stop N uwsgi workers from recomputing the same expensive
+cache entry. But with a plain DLock, every waiter still redoes the work after
+acquiring the lock in turn. With single_flight only the lock holder runs fn(),
+then publishes the result as a pickle file next to the lockdir:
+
+    <lockroot>/<name>.result
+
+All who were waiting meanwhile return that result, without ever locking.
+So N computations become 1.
+
+The result is reused only for TTL seconds after it was published.
+If fn() raises, the result file is removed (so no old result is served), and
+the exception goes to the caller. The waiters then compete for the lock again,
+so one of them tries fn() next. If the holder dies, the lock times out, same.
+
+fn's result must be picklable.
+'''
+
+# seconds after publication, during which a result is reused:
+TTL = 5
+
+# result file extension:
+RESULTEXTENSION = ".result"
+
+import os, time
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from lockbydir import DLock
+from lockbydir_OS import writeFileAtomically, readFile, remove_ReturnWhetherSuccessfullyRemoved
+
+
+class SingleFlightTimeout(Exception):
+    "PATIENCE is gone, but neither got the lock, nor found a result."
+
+
+def resultFilename(L):
+    "pathname of the result file, next to the lockdir of DLock 'L'"
+    return os.path.join(L.lockRoot(), L.name + RESULTEXTENSION)
+
+def publishResult(filename, value):
+    "Atomically write the pickled (timestamp, value)."
+    data = pickle.dumps( (time.time(), value), pickle.HIGHEST_PROTOCOL )
+    writeFileAtomically(filename, data)
+
+def readResult(filename, ttl):
+    """Returns (True, value) if a result younger than 'ttl' was published.
+       Else (False, None)."""
+    data = readFile(filename)
+    if data is None:
+        return False, None
+    try:
+        publishedAt, value = pickle.loads(data)
+    except Exception:
+        return False, None # damaged, treat like no result
+    if time.time() - publishedAt > ttl:
+        return False, None
+    return True, value
+
+
+def single_flight(name, fn, ttl = TTL, L = None):
+    """Return fn(), but run fn at most once for all concurrent callers
+       of the same 'name'. Others get the published result.
+
+       L: optional DLock instance (e.g. with own TIMEOUT, PATIENCE),
+          default is DLock(name).
+
+       Raises SingleFlightTimeout if PATIENCE is gone without a result.
+       Raises whatever fn raises, in the caller who ran it."""
+
+    if L is None:
+        L = DLock(name)
+    filename = resultFilename(L)
+    L.startedWaitingTime = time.time()
+
+    while L.stillPatience():
+        found, value = readResult(filename, ttl)
+        if found:
+            return value
+
+        if L.locking():
+            try:
+                # maybe published just before I got the lock:
+                found, value = readResult(filename, ttl)
+                if not found:
+                    try:
+                        value = fn()
+                        publishResult(filename, value)
+                    except:
+                        remove_ReturnWhetherSuccessfullyRemoved(filename)
+                        raise
+                return value
+            finally:
+                L.unlocking()
+
+        L.loopWhileLocked()
+
+    raise SingleFlightTimeout("no result for '%s' within PATIENCE = %s seconds"
+                              % (name, L.PATIENCE))
+
+
+def expensive(secs, calls):
+    "example computation, which notes each time it really runs"
+    calls.append(1)
+    time.sleep(secs)
+    return "the answer is 42"
+
+def testSingleFlight(n = 10):
+    "n threads want the same expensive result. Should compute only once."
+
+    import threading
+    calls, answers = [], []
+    name = "singleFlightExample"
+    remove_ReturnWhetherSuccessfullyRemoved(resultFilename(DLock(name)))
+
+    def worker():
+        answers.append(single_flight(name, lambda: expensive(0.5, calls)))
+
+    t = [threading.Thread(target = worker) for _ in range(n)]
+    for thr in t: thr.start()
+    for thr in t: thr.join()
+
+    print "%d callers, %d answers, fn ran %d times:" % (n, len(answers), len(calls)),
+    print set(answers)
+
+    print "failing fn invalidates the result:",
+    try:
+        single_flight(name + "2", lambda: 1/0)
+    except ZeroDivisionError as e:
+        print "ZeroDivisionError,",
+    print "result file exists = %s" % os.path.exists(resultFilename(DLock(name + "2")))
+
+
+if __name__ == '__main__':
+    testSingleFlight()
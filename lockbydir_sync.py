@@ -0,0 +1,202 @@
+'''
+lockbydir_sync.py - Cross-process Event and Condition, next to DLock.
+
+@requires: lockbydir.py         # the DLock class, and defaults
+@requires: lockbydir_OS.py      # lockdir OS-level routines, doorbells
+
+@call:     E = DEvent( "name" );  E.set();  E.wait( patience )
+@call:     C = DCondition( L );   C.wait( patience );  C.notify()
+@return:   classes, like threading.Event and threading.Condition
+
+@summary
+
+Beyond mutual exclusion: workers waiting for "data is ready" should not have
+to poll with DLock.isLocked() loops.
+
+DEvent: The event is set while its eventdir <name>.event exists in the lock
+root. .set() = mkdir, .clear() = rmdir, .isSet() = exists.
+
+DCondition: Bound to a DLock. .wait() releases the DLock, sleeps until
+notified, then acquires the DLock again. .notify(n), .notify_all().
+
+Waiting is not polling: Each waiter installs a doorbell (a named pipe, see
+lockbydir_OS), and sleeps in select() until rung, or its PATIENCE is gone.
+Only on systems without named pipes (Windows) it checks every DOORBELLPOLL
+seconds.
+'''
+
+# default patience, seconds:
+from lockbydir import PATIENCE
+
+# extensions:
+EVENTEXTENSION = ".event"
+EVENTWAITERSEXTENSION = ".eventwaiters"
+CONDITIONEXTENSION = ".condition"
+
+import os, time
+
+import lockbydir
+from lockbydir import DLock
+from lockbydir_OS import pathExists, defaultLockRoot
+from lockbydir_OS import mkdir_ReturnWhetherSuccessful, rmdir_ReturnWhetherSuccessfullyRemoved
+from lockbydir_OS import doorbellInstall, doorbellWait, doorbellRemove, doorbellRing
+
+
+class DEvent:
+    """Cross-process Event. Several instances with identical 'name's
+       share the same event."""
+
+    def __init__(self, name):
+        self.name = name
+        self.PATIENCE = PATIENCE
+        self.LOCKROOT = lockbydir.LOCKROOT
+
+    def set(self):
+        "Set the event, and wake up all waiters."
+        mkdir_ReturnWhetherSuccessful(self.dirname())
+        doorbellRing(self.waitersDirname())
+
+    def clear(self):
+        "Reset the event."
+        rmdir_ReturnWhetherSuccessfullyRemoved(self.dirname())
+
+    def isSet(self):
+        "Is the event set?"
+        return pathExists(self.dirname())
+
+    def wait(self, patience = None):
+        """Block until the event is set, but max 'patience' seconds
+           (default: PATIENCE). Returns True if set, False if patience gone."""
+        if self.isSet():
+            return True
+        if patience is None:
+            patience = self.PATIENCE
+        deadline = time.time() + patience
+
+        doorbell = doorbellInstall(self.waitersDirname())
+        try:
+            while not self.isSet(): # again after each wakeup, e.g. a signal
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                if doorbellWait(doorbell, remaining) and doorbell is not None:
+                    return True # rung by set(), perhaps already cleared: a pulse
+            return True
+        finally:
+            doorbellRemove(doorbell)
+
+    # end PUBLIC functions.
+    # begin PRIVATE functions. Usually no need to call them:
+
+    def lockRoot(self):
+        return self.LOCKROOT if self.LOCKROOT is not None else defaultLockRoot()
+
+    def dirname(self):
+        "the eventdir, exists while the event is set"
+        return os.path.join(self.lockRoot(), self.name + EVENTEXTENSION)
+
+    def waitersDirname(self):
+        "the doorbells of the waiters"
+        return os.path.join(self.lockRoot(), self.name + EVENTWAITERSEXTENSION)
+
+
+class DCondition:
+    """Cross-process Condition, bound to a DLock 'L'.
+
+       Use it like threading.Condition:
+           if L.LoopWhileLocked_ThenLocking():
+               while not dataReady():
+                   if not C.wait(): break # ...
+               ...
+               L.unlocking()"""
+
+    def __init__(self, L):
+        self.L = L
+
+    def wait(self, patience = None):
+        """Release the lock, sleep until notified (or 'patience' seconds gone,
+           default: the DLock's PATIENCE), then wait to acquire the lock again.
+
+           Returns True if notified, and lock acquired again.
+           Returns False if not notified, or lock not acquired again."""
+        if self.L.lockingTime is None:
+            raise RuntimeError("cannot wait on an un-acquired DLock")
+        if patience is None:
+            patience = self.L.PATIENCE
+
+        deadline = time.time() + patience
+        doorbell = doorbellInstall(self.waitersDirname()) # before unlocking!
+        try:
+            self.L.unlocking()
+            notified = False
+            while not notified and time.time() < deadline: # again after a signal
+                notified = doorbellWait(doorbell, deadline - time.time())
+        finally:
+            doorbellRemove(doorbell)
+
+        return self.L.LoopWhileLocked_ThenLocking() and notified
+
+    def notify(self, n = 1):
+        "Wake up the 'n' longest waiting ones. Returns how many."
+        return doorbellRing(self.waitersDirname(), n)
+
+    def notify_all(self):
+        "Wake up all waiting ones. Returns how many."
+        return doorbellRing(self.waitersDirname())
+
+    # end PUBLIC functions.
+    # begin PRIVATE functions. Usually no need to call them:
+
+    def waitersDirname(self):
+        "the doorbells of the waiters, next to the lockdir"
+        return os.path.join(self.L.lockRoot(), self.L.name + CONDITIONEXTENSION)
+
+
+def testDEvent():
+    "A waiter should wake up right after .set(), not one poll interval later."
+
+    import threading
+    E = DEvent("eventExample")
+    E.clear()
+    setAt = []
+
+    def producer():
+        time.sleep(0.3)
+        setAt.append(time.time())
+        E.set()
+
+    threading.Thread(target = producer).start()
+    print "waiting for event ...",
+    print "isSet = %s" % E.wait(5),
+    print "woken up %.4f seconds after set." % (time.time() - setAt[0])
+    E.clear()
+    print "after clear: wait(0.2) = %s" % E.wait(0.2)
+
+def testDCondition(n = 3):
+    "n consumers wait on a condition, one notify_all wakes them all up."
+
+    import threading
+    results = []
+
+    def consumer(i):
+        L = DLock("conditionExample")
+        C = DCondition(L)
+        if L.LoopWhileLocked_ThenLocking():
+            results.append( (i, C.wait(5)) )
+            L.unlocking()
+
+    t = [threading.Thread(target = consumer, args = (i,)) for i in range(n)]
+    for thr in t: thr.start()
+    time.sleep(0.5)
+
+    L = DLock("conditionExample")
+    L.LoopWhileLocked_ThenLocking()
+    print "notify_all woke up %d waiters." % DCondition(L).notify_all(),
+    L.unlocking()
+    for thr in t: thr.join()
+    print "Results (consumer, notified and relocked):", sorted(results)
+
+
+if __name__ == '__main__':
+    testDEvent()
+    testDCondition()